@@ -5,13 +5,14 @@
 #
 # Author: Naor Movshovitz (nmovshov at gee mail dot com)
 #---------------------------------------------------------------------------------
-import sys, os, glob
+import sys, os
 import numpy as np
 import argparse
-import re
-# import ahelpers
+import ahelpers
+import gravtree
 from time import time
-from numba import jit
+import numba
+from numba import jit, prange
 cout = sys.stdout.write
 
 def _main():
@@ -19,34 +20,42 @@ def _main():
 
     # Parse command line arguments
     args = _PCL()
+    if args.cache:
+        ahelpers.use_disk_cache(args.cache)
 
     # Super ad hoc feature to sort output from fnls with no leading 0s
     if args.sort_output:
         sort_output(args.filename)
         sys.exit(0)
 
-    # Ad hoc file-by-file treatment
+    # Snapshot-by-snapshot treatment, picked from the catalog of the run
+    # directory (or the index of a time series) without opening any
     if os.path.isfile(args.filename):
-        allfiles = [args.filename]
         dirname = os.path.dirname(os.path.abspath(args.filename))
     else:
         dirname = os.path.abspath(args.filename)
-        allfiles = glob.glob(os.path.join(dirname, '*.fnl')) + \
-                   glob.glob(os.path.join(dirname, '*.fnl.gz'))
-        allfiles.sort()
-    if len(allfiles) == 0:
-        print "{} does not contain any valid fnl or fnl.gz files.".format(dirname)
+    snapshots = ahelpers.find_snapshots(args.filename, args.tmin, args.tmax,
+                                        args.stride)
+    if len(snapshots) == 0:
+        print "{} does not contain any valid fnl, fnl.gz, fnlb, fnlm, h5, or fnls files in range.".format(
+            dirname)
         return
     
     ot = time()
     print
     # out_table = np.nan*np.ones([len(allfiles), 2 + len(args.method)])
     out_table = []
-    for onefile in allfiles:
+    for snap in snapshots:
         # Load node list data
-        cout("Reading file {}...".format(os.path.relpath(onefile)))
+        onefile = snap['path']
+        if onefile.endswith(ahelpers.FNLSMeta.extension):
+            cout("Reading step {} of {}...".format(snap['step'],
+                                                   os.path.relpath(onefile)))
+        else:
+            cout("Reading file {}...".format(os.path.relpath(onefile)))
         try:
-            fnl = ahelpers.load_fnl(onefile)
+            fnl = ahelpers.load_fnl(onefile,
+                columns=['id','x','y','z','vx','vy','vz','m'], step=snap['step'])
             cout("Done.\n")
             pos = np.vstack((fnl.x, fnl.y, fnl.z)).T
             vel = np.vstack((fnl.vx, fnl.vy, fnl.vz)).T
@@ -58,6 +67,7 @@ def _main():
                     n, sum(m[fnl.id == n]), sum(fnl.id == n),
                     sum(m[fnl.id == n])/sum(fnl.id == n))
         except StandardError:
+            fnl = None
             try:
                 raw = np.loadtxt(onefile, delimiter=args.delimiter)
                 cout("Done.\n")
@@ -75,20 +85,22 @@ def _main():
                 raise StandardError("Could not read data from {}".format(
                     onefile))
 
-        # Extract time and step info from file name
+        # Extract time and step info from binary header or catalog
         out_this_file = []
-        try:
-            out_this_file.append(int(re.search(r'-\d+', onefile).group()[1:]))
-            out_this_file.append(float(re.findall(r'-[\d.]+', onefile)[1][1:-1]))
-        except:
-            pass
+        if getattr(fnl, 'step', -1) >= 0:
+            out_this_file.append(fnl.step)
+            out_this_file.append(fnl.time)
+        elif snap['step'] >= 0:
+            out_this_file.append(snap['step'])
+            out_this_file.append(snap['time'])
 
         # Include total mass in file output
         out_this_file.append(sum(m))
 
         # An ad hoc feature to calculate binding energy as well
         if args.binding_energy:
-            gU = grav_binding_energy(pos, m)
+            gU = grav_binding_energy(pos, m, potential=args.potential,
+                                     theta=args.theta, threads=args.threads)
             out_this_file.append(gU)
             print "System gravitational binding energy Ug = {:g} J.".format(gU)
             pass
@@ -105,7 +117,10 @@ def _main():
                                               method=args.method[k],
                                               length_scale=args.length_scale,
                                               units=units,
-                                              margs=args)
+                                              margs=args,
+                                              potential=args.potential,
+                                              theta=args.theta,
+                                              threads=args.threads)
             print "Found {:g} kg in {:g} particles; M_bound/M_tot = {:.4g}.".format(
                 M_bound, sum(ind_bound), M_bound/sum(m))
             print "Elapsed time = {:g} sec.".format(time() - tic)
@@ -139,7 +154,8 @@ def _main():
         pass
     return
 
-def bound_mass(pos, vel, m, method, length_scale=0, units=[1,1,1], margs=None):
+def bound_mass(pos, vel, m, method, length_scale=0, units=[1,1,1], margs=None,
+               potential='exact', theta=0.5, threads=0):
     """Given cloud of particles return largest gravitationally bound mass.
 
     This function looks at a cloud of point masses with known positions and
@@ -153,11 +169,16 @@ def bound_mass(pos, vel, m, method, length_scale=0, units=[1,1,1], margs=None):
     The choices implemented currently are:
       'kory1' - In the RF of the particle with lowest potential return the
                 particles with negative total energy.
-      'kory2' - In the RF with the most particles with negative total energy among
-                all possible RFs centered on a particle return the particles with
-                negative energy.
+      'kory2' - In the RF with the most mass with negative total energy among
+                the RFs centered on the margs.candidates particles with lowest
+                potential return the particles with negative energy. The
+                candidate RFs are tried in margs.processes processes (0, the
+                default, for one per cpu).
       'jutzi' - In the RF of the particle with lowest potential remove particles
-                with positive total energy. Repeat until stable.
+                with positive total energy. Repeat until stable. (With the exact
+                potential, each pass only subtracts the pull of the particles
+                removed in the previous one; set margs.refresh to k to recompute
+                it from scratch every k passes.)
       'naor1' - Add particles bound to the particle with lowest potential. In the
                 CM frame of this set, add particles bound to the set. Repeat until
                 stable.
@@ -170,6 +191,14 @@ def bound_mass(pos, vel, m, method, length_scale=0, units=[1,1,1], margs=None):
 
     This function is a dispatcher - the work is carried out in sub functions.
 
+    The gravitational potential of the particles is computed by the method chosen
+    with the potential argument:
+      'exact' - Direct summation over all pairs, O(N^2), split among threads
+                (default 0: all cores) in parallel.
+      'tree'  - Barnes-Hut octree (see gravtree.tree_potential), O(N log N), with
+                opening angle theta. The largest relative error of the potential
+                among a sample of particles is reported when done.
+
     Parameters
     ----------
     pos : n-by-3 numeric array
@@ -186,6 +215,15 @@ def bound_mass(pos, vel, m, method, length_scale=0, units=[1,1,1], margs=None):
         Override default length scale used in algorithm naor2
     margs : argparse namespace
         All the command line argments just in case we need any.
+    potential : string, optional
+        Potential engine to use, 'exact' or 'tree'.
+    theta : numeric in [0, 1), optional
+        Opening angle of the tree engine.
+    threads : int, optional
+        Number of threads for the exact engine; 0 (default) means all cores and
+        1 means the serial kernel. Numba before 0.49 can not limit its threads
+        at run time, so there any other value means all NUMBA_NUM_THREADS
+        threads (set that environment variable to use fewer).
 
     Returns
     -------
@@ -199,7 +237,7 @@ def bound_mass(pos, vel, m, method, length_scale=0, units=[1,1,1], margs=None):
     pos = np.array(pos)
     vel = np.array(vel)
     m   = np.array(m)
-    units = np.array(units)
+    units = np.array(units, dtype=float)
     assert pos.ndim == 2 and pos.shape[1] == 3 and np.all(np.isreal(pos))
     assert vel.ndim == 2 and vel.shape[1] == 3 and np.all(np.isreal(vel))
     assert m.ndim == 1 and np.all(np.isreal(m)) and np.all(m > 0)
@@ -207,27 +245,39 @@ def bound_mass(pos, vel, m, method, length_scale=0, units=[1,1,1], margs=None):
     assert len(pos) == len(vel) == len(m)
     assert method in ['kory1', 'kory2', 'jutzi', 'naor1', 'naor2', 'naor3']
     assert np.size(length_scale) == 1 and np.isreal(length_scale)
+    assert potential in ['exact', 'tree']
+    assert 0 <= theta < 1
+    assert threads >= 0
     if margs is None:
         class margs:
             max_iter = 20
+            refresh = 0
+            candidates = 64
+            processes = 0
             pass
 
     # Deal with units
     bigG = 6.67384e-11*units[0]**(-3)*units[1]*units[2]**2
     length_scale = length_scale*units[0]
+    potfun = _potential_engine(potential, theta, threads)
 
     # Dispatch to sub functions by method
     if   method == 'kory1':
-        (M_bound, ind_bound) = _bm_kory1(pos, vel, m, bigG)
+        (M_bound, ind_bound) = _bm_kory1(pos, vel, m, bigG, potfun)
         pass
     elif method == 'kory2':
-        (M_bound, ind_bound) = _bm_kory2(pos, vel, m, bigG)
+        (M_bound, ind_bound) = _bm_kory2(pos, vel, m, bigG, potfun,
+                                         getattr(margs, 'candidates', 64),
+                                         getattr(margs, 'processes', 0))
         pass
     elif method == 'jutzi':
-        (M_bound, ind_bound) = _bm_jutzi(pos, vel, m, bigG, margs.max_iter)
+        (M_bound, ind_bound) = _bm_jutzi(pos, vel, m, bigG, margs.max_iter,
+                                         potfun, potential == 'exact',
+                                         getattr(margs, 'refresh', 0), threads)
         pass
     elif method == 'naor1':
-        (M_bound, ind_bound) = _bm_naor1(pos, vel, m, bigG, margs.max_iter)
+        (M_bound, ind_bound) = _bm_naor1(pos, vel, m, bigG, margs.max_iter,
+                                         potfun)
         pass
     elif method == 'naor2':
         (M_bound, ind_bound) = _bm_naor2(pos, vel, m, bigG, length_scale)
@@ -237,105 +287,141 @@ def bound_mass(pos, vel, m, method, length_scale=0, units=[1,1,1], margs=None):
     else:
         sys.exit("Unknown method") # this can't really happen
         pass
+    if potential == 'tree' and potfun.calls > 0:
+        print "Tree potential (theta={:g}): max sampled relative error {:.2g}.".format(
+            theta, potfun.error)
 
     return (M_bound, ind_bound)
 
-def _bm_kory1(pos, vel, m, bigG):
+def _bm_kory1(pos, vel, m, bigG, potfun=None):
     """In RF of lowest potential node return nodes with negative energy."""
-    U = bigG*_potential(pos[:,0], pos[:,1], pos[:,2], m);
+    potfun = potfun or _potential
+    U = bigG*potfun(pos[:,0], pos[:,1], pos[:,2], m);
     ind = np.argmin(U)
     VCM = vel[ind,:]
-    ind_bound = np.array(len(m)*[False])
-    for j in range(len(m)):
-        V = vel[j,:] - VCM
-        K = 0.5*(V[0]*V[0] + V[1]*V[1] + V[2]*V[2])
-        if K + U[j] < 0:
-            ind_bound[j] = True
-            pass
-        pass
-    pass
+    ind_bound = _kinetic(vel, VCM) + U < 0
     print "Done."
-    return (sum(m[ind_bound]), ind_bound)
+    return (_seqsum(m[ind_bound]), ind_bound)
 
-def _bm_kory2(pos, vel, m, bigG):
-    """Use RF with most bound nodes among all possible RFs centered on a node."""
-    U = bigG*_potential(pos[:,0], pos[:,1], pos[:,2], m);
-    max_M = -np.inf
-    ind_bound = np.array(len(m)*[False])
-    K = np.zeros(len(m))
-    for j in range(len(m)):
-        VCM = vel[j]
-        for k in range(len(m)):
-            V = vel[j,:] - VCM
-            K[k] = 0.5*(V[0]*V[0] + V[1]*V[1] + V[2]*V[2])
-            pass
-        mask = K + U < 0
-        if sum(m[mask]) > max_M:
-            ind_bound = mask
-            pass
-        pass
-    pass
-    print "Done."
-    return (sum(m[ind_bound]), ind_bound)
+def _bm_kory2(pos, vel, m, bigG, potfun=None, candidates=64, processes=0):
+    """Use RF with most bound mass among RFs centered on the deepest nodes.
 
-def _bm_jutzi(pos, vel, m, bigG, maxiter):
-    """In RF of lowest potential remove nodes with positive energy and repeat."""
-    bU = bigG*_potential(pos[:,0], pos[:,1], pos[:,2], m)
-    ind = np.argmin(bU)
+    The candidate frames are those of the candidates nodes with lowest potential
+    (all nodes if candidates <= 0), tried in order of potential. Each frame is
+    evaluated in O(N) whole-array operations, and with processes other than 1 the
+    frames are split among a pool of that many processes (0, the default, for one
+    per cpu, as in bound_mass and the command line). The first frame with the
+    largest bound mass wins and is reported.
+    """
+    potfun = potfun or _potential
+    U = bigG*potfun(pos[:,0], pos[:,1], pos[:,2], m);
+    frames = np.argsort(U, kind='mergesort')
+    if candidates > 0:
+        frames = frames[:candidates]
+    if processes == 0:
+        processes = ahelpers._nb_workers()
+    processes = max(1, min(processes, len(frames)//8))
+
+    # Bound mass in every candidate frame
+    if processes == 1:
+        _kory2_init(vel, U, m)
+        masses = _kory2_masses(frames)
+        _kory2_init(None, None, None)
+    else:
+        import multiprocessing
+        chunks = np.array_split(frames, 4*processes)
+        pool = multiprocessing.Pool(processes, _kory2_init, (vel, U, m))
+        try:
+            masses = np.concatenate(pool.map(_kory2_masses, chunks))
+        finally:
+            pool.close()
+            pool.join()
+
+    # The first best frame wins
+    best = np.argmax(masses)
+    ind_bound = _kinetic(vel, vel[frames[best]]) + U < 0
+    print "Done (frame of node {}, potential rank {} of {} tried).".format(
+        frames[best], best + 1, len(frames))
+    return (_seqsum(m[ind_bound]), ind_bound)
+
+def _kory2_init(vel, U, m):
+    """Keep the data for _kory2_masses (also in pool worker processes)."""
+    global _kory2_data
+    _kory2_data = (vel, U, m)
+
+def _kory2_masses(frames):
+    """Bound mass in the frames of the given nodes, from _kory2_data."""
+    (vel, U, m) = _kory2_data
+    masses = np.zeros(len(frames))
+    for (i, j) in enumerate(frames):
+        masses[i] = np.sum(m[_kinetic(vel, vel[j]) + U < 0])
+    return masses
+
+def _bm_jutzi(pos, vel, m, bigG, maxiter, potfun=None, incremental=False,
+              refresh=0, threads=1):
+    """In RF of lowest potential remove nodes with positive energy and repeat.
+
+    With incremental=True the potential of the remaining nodes is updated by
+    subtracting the pull of the nodes removed since the last pass, in
+    O(removed*N), instead of recomputed, unless more than half the remaining
+    nodes were removed. If refresh > 0 it is recomputed every refresh passes
+    anyway, to bound the accumulated roundoff. The update uses threads threads,
+    as in _potential.
+    """
+    potfun = potfun or _potential
+    U = potfun(pos[:,0], pos[:,1], pos[:,2], m)
+    ind = np.argmin(U)
     VCM = vel[ind,:]
+    K = _kinetic(vel, VCM)
     ind_bound = np.array(len(m)*[True])
+    last_bound = ind_bound.copy() # the nodes pulling in U
     nbb = -1
     citer = 0
-    while (nbb != sum(ind_bound)) and (citer < maxiter):
+    while (nbb != np.count_nonzero(ind_bound)) and (citer < maxiter):
         citer += 1
         print 'i{}'.format(citer), '\b'*(3 + len(str(citer))),
         sys.stdout.flush()
-        nbb = sum(ind_bound)
-        bU = bigG*_potential(pos[:,0], pos[:,1], pos[:,2], m, ind_bound)
-        for j in range(len(m)):
-            V = vel[j,:] - VCM
-            K = 0.5*(V[0]*V[0] + V[1]*V[1] + V[2]*V[2])
-            if K + bU[j] > 0.0:
-                ind_bound[j] = False
-                pass
-            pass
+        nbb = np.count_nonzero(ind_bound)
+        removed = np.flatnonzero(last_bound & ~ind_bound)
+        if (not incremental or 2*len(removed) > nbb or
+            (refresh > 0 and citer % refresh == 0)):
+            U = potfun(pos[:,0], pos[:,1], pos[:,2], m, ind_bound)
+        elif len(removed) > 0:
+            U = _potential_drop(pos[:,0], pos[:,1], pos[:,2], m, U, ind_bound,
+                                removed, threads)
+        last_bound = ind_bound.copy()
+        bU = bigG*U
+        ind_bound &= ~(K + bU > 0.0)
         pass
     pass
     print "Done (i={}).".format(citer)
-    return (sum(m[ind_bound]), ind_bound)
+    return (_seqsum(m[ind_bound]), ind_bound)
 
-def _bm_naor1(pos, vel, m, bigG, maxiter):
+def _bm_naor1(pos, vel, m, bigG, maxiter, potfun=None):
     """Add nodes bound to CM of bound nodes until stable. Seed with lowest U."""
+    potfun = potfun or _potential
     ind_bound = np.array(len(m)*[False])
-    U = bigG*_potential(pos[:,0], pos[:,1], pos[:,2], m)
+    U = bigG*potfun(pos[:,0], pos[:,1], pos[:,2], m)
     ind = np.argmin(U)
     ind_bound[ind] = True
     nbb = -1
     citer = 0
     m3 = np.tile(m,(3,1)).T
-    while (nbb != sum(ind_bound)) and (citer < maxiter):
+    while (nbb != np.count_nonzero(ind_bound)) and (citer < maxiter):
         citer += 1
         print 'i{}'.format(citer), '\b'*(3 + len(str(citer))),
         sys.stdout.flush()
-        nbb = sum(ind_bound)
-        M = sum(m[ind_bound])
+        nbb = np.count_nonzero(ind_bound)
+        M = _seqsum(m[ind_bound])
         cmpos = np.sum(m3[ind_bound,:]*pos[ind_bound,:], 0)/M
         cmvel = np.sum(m3[ind_bound,:]*vel[ind_bound,:], 0)/M
-        for j in range(len(m)):
-            dR = pos[j,:] - cmpos
-            dr = np.sqrt(np.dot(dR, dR)) + np.spacing(1)
-            U = -bigG*M/dr
-            V = vel[j,:] - cmvel
-            K = 0.5*(V[0]*V[0] + V[1]*V[1] + V[2]*V[2])
-            if K + U < 0.0:
-                ind_bound[j] = True
-            else:
-                ind_bound[j] = False
-            pass
+        dr = np.sqrt(_norm2(pos, cmpos)) + np.spacing(1)
+        U = -bigG*M/dr
+        ind_bound = _kinetic(vel, cmvel) + U < 0.0
         pass
     pass
     print "Done (i={}).".format(citer)
-    return (sum(m[ind_bound]), ind_bound)
+    return (_seqsum(m[ind_bound]), ind_bound)
 
 def _bm_naor3(pos, vel, m, bigG, maxiter):
     """Add nodes bound to CM of bound nodes until stable. Seed with nearest CM."""
@@ -343,43 +429,41 @@ def _bm_naor3(pos, vel, m, bigG, maxiter):
     m3 = np.tile(m,(3,1)).T
     M = sum(m)
     cmpos = np.sum(m3*pos, 0)/M
-    dR = np.inf
-    for k in range(len(m)):
-        dr = cmpos - pos[k]
-        dr = np.sqrt(dr.dot(dr))
-        if dr < dR:
-            dR = dr
-            ind = k
-        pass
-    pass
+    ind = np.argmin(np.sqrt(_norm2(pos, cmpos)))
     # Seed with this node and start to iterate
     ind_bound = np.array(len(m)*[False])
     ind_bound[ind] = True
     nbb = -1
     citer = 0
-    while (nbb != sum(ind_bound)) and (citer < maxiter):
+    while (nbb != np.count_nonzero(ind_bound)) and (citer < maxiter):
         citer += 1
         print 'i{}'.format(citer), '\b'*(3 + len(str(citer))),
         sys.stdout.flush()
-        nbb = sum(ind_bound)
-        M = sum(m[ind_bound])
+        nbb = np.count_nonzero(ind_bound)
+        M = _seqsum(m[ind_bound])
         cmpos = np.sum(m3[ind_bound,:]*pos[ind_bound,:], 0)/M
         cmvel = np.sum(m3[ind_bound,:]*vel[ind_bound,:], 0)/M
-        for j in range(len(m)):
-            dR = pos[j,:] - cmpos
-            dr = np.sqrt(np.dot(dR, dR)) + np.spacing(1)
-            U = -bigG*M/dr
-            V = vel[j,:] - cmvel
-            K = 0.5*(V[0]*V[0] + V[1]*V[1] + V[2]*V[2])
-            if K + U < 0.0:
-                ind_bound[j] = True
-            else:
-                ind_bound[j] = False
-            pass
+        dr = np.sqrt(_norm2(pos, cmpos)) + np.spacing(1)
+        U = -bigG*M/dr
+        ind_bound = _kinetic(vel, cmvel) + U < 0.0
         pass
     pass
     print "Done (i={}).".format(citer)
-    return (sum(m[ind_bound]), ind_bound)
+    return (_seqsum(m[ind_bound]), ind_bound)
+
+def _kinetic(vel, V0):
+    """Specific kinetic energy of all nodes in the frame moving with velocity V0."""
+    V = vel - V0
+    return 0.5*(V[:,0]*V[:,0] + V[:,1]*V[:,1] + V[:,2]*V[:,2])
+
+def _norm2(pos, R0):
+    """Squared distance of all nodes from point R0."""
+    dR = pos - R0
+    return dR[:,0]*dR[:,0] + dR[:,1]*dR[:,1] + dR[:,2]*dR[:,2]
+
+def _seqsum(a):
+    """Sum of a added in order, like the builtin sum (np.sum adds pairwise)."""
+    return np.cumsum(a)[-1] if len(a) else 0
 
 def _bm_naor2(pos, vel, m, bigG, length_scale):
     """Add nodes bound to CM of largest spatially contiguous clump."""
@@ -485,7 +569,7 @@ def _PCL():
     known_methods = ['kory1', 'kory2', 'jutzi', 'naor1', 'naor2', 'naor3']
     parser = argparse.ArgumentParser()
     parser.add_argument('filename',
-        help="name of file containing node list data")
+        help="name of file containing node list data, or run directory")
     parser.add_argument('-m','--method',
         help="choice of algorithm; may be specified multiple times",
         choices=known_methods + ['all'],
@@ -517,6 +601,50 @@ def _PCL():
         help="name of file to save output to",
         type=str,
         default=None)
+    parser.add_argument('--tmin',
+        help="skip snapshots before this time (sec)",
+        type=float,
+        default=None)
+    parser.add_argument('--tmax',
+        help="skip snapshots after this time (sec)",
+        type=float,
+        default=None)
+    parser.add_argument('--stride',
+        help="use every STRIDE-th snapshot (after time selection)",
+        type=int,
+        default=1)
+    parser.add_argument('--cache',
+        help="keep decoded ascii snapshots in CACHE for faster re-reads",
+        default=None)
+    parser.add_argument('--potential',
+        help="gravitational potential engine: exact O(N^2) sum or O(N log N) tree",
+        choices=['exact', 'tree'],
+        default='exact')
+    parser.add_argument('--theta',
+        help="opening angle of the tree potential (smaller is more accurate)",
+        type=float,
+        default=0.5)
+    parser.add_argument('--refresh',
+        help="in jutzi, recompute the potential every K passes instead of "
+             "only updating it (default: never)",
+        metavar='K',
+        type=int,
+        default=0)
+    parser.add_argument('--candidates',
+        help="in kory2, number of lowest potential nodes to try as frames "
+             "(0 for all)",
+        type=int,
+        default=64)
+    parser.add_argument('--processes',
+        help="in kory2, number of processes trying frames (default: 0, one per "
+             "cpu)",
+        type=int,
+        default=0)
+    parser.add_argument('--threads',
+        help="number of threads for the exact potential (default: all cores; "
+             "with numba < 0.49 any value but 1 means NUMBA_NUM_THREADS)",
+        type=int,
+        default=0)
     args = parser.parse_args()
     if 'all' in args.method:
         args.method = known_methods
@@ -526,10 +654,51 @@ def _PCL():
         pass
     return args
 
-def _potential(x, y, z, m, mask=None):
+def _potential(x, y, z, m, mask=None, threads=1):
     if mask is None:
         mask = np.array(len(x)*[True])
-    return _c_potential(x, y, z, m, mask)
+    if threads == 1 or len(x) < 2000:
+        return _c_potential(x, y, z, m, mask)
+    # Two blocks per thread keep all threads busy in every round
+    threads = _nb_threads(threads)
+    return _call_with_threads(threads, _c_potential_parallel, x, y, z, m, mask,
+                              2*threads)
+
+def _nb_threads(threads):
+    """The number of threads a parallel kernel will run on, for a threads option."""
+    if threads == 0 or not hasattr(numba, 'set_num_threads'):
+        return numba.config.NUMBA_NUM_THREADS
+    return min(threads, numba.config.NUMBA_NUM_THREADS)
+
+def _call_with_threads(threads, kernel, *args):
+    """Call a parallel kernel on threads threads, restoring the count after."""
+    if not hasattr(numba, 'set_num_threads'): # numba < 0.49 uses them all
+        return kernel(*args)
+    saved = numba.get_num_threads()
+    numba.set_num_threads(threads)
+    try:
+        return kernel(*args)
+    finally:
+        numba.set_num_threads(saved)
+
+def _potential_engine(potential='exact', theta=0.5, threads=1):
+    """Return a function like _potential using the named engine.
+
+    The tree engine function also keeps count of its calls and the largest
+    sampled relative error (see gravtree.potential_error) in its calls and error
+    attributes.
+    """
+    if potential == 'exact':
+        return lambda x, y, z, m, mask=None: _potential(x, y, z, m, mask, threads)
+    def potfun(x, y, z, m, mask=None):
+        (U, dU) = gravtree.tree_potential(x, y, z, m, mask, theta)
+        potfun.calls += 1
+        potfun.error = max(potfun.error,
+                           gravtree.potential_error(x, y, z, m, U, mask))
+        return U
+    potfun.calls = 0
+    potfun.error = 0.0
+    return potfun
 
 @jit
 def _c_potential(x, y, z, m, mask):
@@ -550,6 +719,48 @@ def _c_potential(x, y, z, m, mask):
         pass
     return U
 
+@jit(nopython=True, parallel=True)
+def _c_potential_parallel(x, y, z, m, mask, nb):
+    # Same pairs as _c_potential, with the nodes split in nb (even) blocks. The
+    # pairs within a block, and those between two blocks (a tile), are done in
+    # rounds of a round-robin schedule: in each round no two tiles share a block,
+    # so they scatter into U without races and without scratch arrays.
+    n = len(x)
+    U = np.zeros(x.shape)
+    for b in prange(nb):
+        lo = b*n//nb
+        hi = (b + 1)*n//nb
+        for j in range(lo, hi):
+            if mask[j]:
+                for k in range(lo, j):
+                    if mask[k]:
+                        dx = x[j] - x[k]
+                        dy = y[j] - y[k]
+                        dz = z[j] - z[k]
+                        dr = np.sqrt(dx*dx + dy*dy + dz*dz) + 1e-12
+                        U[j] = U[j] - m[k]/dr
+                        U[k] = U[k] - m[j]/dr
+    for r in range(nb - 1):
+        for p in prange(nb//2):
+            # Block nb-1 stays put, the others rotate (the circle method)
+            if p == 0:
+                bj = nb - 1
+                bk = r
+            else:
+                bj = (r + p) % (nb - 1)
+                bk = (r - p + nb - 1) % (nb - 1)
+            for j in range(bj*n//nb, (bj + 1)*n//nb):
+                if mask[j]:
+                    for k in range(bk*n//nb, (bk + 1)*n//nb):
+                        if mask[k]:
+                            dx = x[j] - x[k]
+                            dy = y[j] - y[k]
+                            dz = z[j] - z[k]
+                            dr = np.sqrt(dx*dx + dy*dy + dz*dz) + 1e-12
+                            U[j] = U[j] - m[k]/dr
+                            U[k] = U[k] - m[j]/dr
+    return U
+
 def sort_output(filename):
     raw = np.loadtxt(filename)
     ind = np.argsort(raw[:,1]) # indices to sort by time (2nd col)
@@ -564,9 +775,51 @@ def sort_output(filename):
         delimiter='  ')
     pass
 
-def grav_binding_energy(pos, m, units=[1,1,1]):
+def _potential_drop(x, y, z, m, U, mask, removed, threads=1):
+    if threads == 1 or len(x) < 2000:
+        return _c_potential_drop(x, y, z, m, U, mask, removed)
+    return _call_with_threads(_nb_threads(threads),
+                              _c_potential_drop_parallel, x, y, z, m, U, mask,
+                              removed)
+
+@jit(nopython=True)
+def _c_potential_drop(x, y, z, m, U, mask, removed):
+    # U less the pull of the removed nodes, for nodes still in mask (0 for others)
+    V = np.zeros(x.shape)
+    for j in range(len(x)):
+        if mask[j]:
+            u = U[j]
+            for i in range(len(removed)):
+                k = removed[i]
+                dx = x[j] - x[k]
+                dy = y[j] - y[k]
+                dz = z[j] - z[k]
+                u = u + m[k]/(np.sqrt(dx*dx + dy*dy + dz*dz) + 1e-12)
+            V[j] = u
+    return V
+
+@jit(nopython=True, parallel=True)
+def _c_potential_drop_parallel(x, y, z, m, U, mask, removed):
+    # Same as _c_potential_drop, with the nodes split among threads
+    V = np.zeros(x.shape)
+    for j in prange(len(x)):
+        if mask[j]:
+            u = U[j]
+            for i in range(len(removed)):
+                k = removed[i]
+                dx = x[j] - x[k]
+                dy = y[j] - y[k]
+                dz = z[j] - z[k]
+                u = u + m[k]/(np.sqrt(dx*dx + dy*dy + dz*dz) + 1e-12)
+            V[j] = u
+    return V
+
+def grav_binding_energy(pos, m, units=[1,1,1], potential='exact', theta=0.5,
+                        threads=0):
+    units = np.array(units, dtype=float)
     bigG = 6.67384e-11*units[0]**(-3)*units[1]*units[2]**2
-    U = bigG*_potential(pos[:,0], pos[:,1], pos[:,2], m)
+    potfun = _potential_engine(potential, theta, threads)
+    U = bigG*potfun(pos[:,0], pos[:,1], pos[:,2], m)
     return 0.5*sum(U*m)
     pass
 
@@ -4,7 +4,7 @@
 #
 # Author: Naor Movshovitz (nmovshov at gee mail dot com)
 #---------------------------------------------------------------------------------
-import sys, os, glob
+import sys, os
 import numpy as np
 import argparse
 import ahelpers
@@ -16,27 +16,35 @@ def _main():
 
     # Parse command line arguments
     args = _PCL()
+    if args.cache:
+        ahelpers.use_disk_cache(args.cache)
 
-    # Ad hoc file-by-file treatment
+    # Snapshot-by-snapshot treatment, picked from the catalog of the run
+    # directory (or the index of a time series) without opening any
     if os.path.isfile(args.filename):
-        allfiles = [args.filename]
         dirname = os.path.dirname(os.path.abspath(args.filename))
     else:
         dirname = os.path.abspath(args.filename)
-        allfiles = glob.glob(os.path.join(dirname, '*.fnl')) + \
-                   glob.glob(os.path.join(dirname, '*.fnl.gz'))
-        allfiles.sort()
-    if len(allfiles) == 0:
-        print "{} does not contain any valid fnl or fnl.gz files.".format(dirname)
+    snapshots = ahelpers.find_snapshots(args.filename, args.tmin, args.tmax,
+                                        args.stride)
+    if len(snapshots) == 0:
+        print "{} does not contain any valid fnl, fnl.gz, fnlb, fnlm, h5, or fnls files in range.".format(
+            dirname)
         return
     
     ot = time()
     print
-    for onefile in allfiles:
+    for snap in snapshots:
         # Load node list data
-        cout("Reading file {}...".format(os.path.relpath(onefile)))
+        onefile = snap['path']
+        inseries = onefile.endswith(ahelpers.FNLSMeta.extension)
+        if inseries:
+            cout("Reading step {} of {}...".format(snap['step'],
+                                                   os.path.relpath(onefile)))
+        else:
+            cout("Reading file {}...".format(os.path.relpath(onefile)))
         try:
-            fnl = ahelpers.load_fnl(onefile)
+            fnl = ahelpers.load_fnl(onefile, step=snap['step'])
             cout("Done.\n")
             print "Found {2} kg in {1} node lists ({0} nodes total).".format(
                 fnl.nbNodes, np.unique(fnl.id).size, sum(fnl.m))
@@ -62,6 +70,11 @@ def _main():
                                                  M_LB,
                                                  ejc.nbNodes)
         outname = os.path.join(dirname, 'ejecta_from_'+os.path.basename(onefile))
+        if inseries: # one file per snapshot, named like the usual output
+            outname = "{}-{:05d}-{:g}.fnlb".format(os.path.splitext(outname)[0],
+                                                   snap['step'], snap['time'])
+        if outname.endswith(('.fnlm','.h5')): # save ejecta in one binary file
+            outname = os.path.splitext(outname)[0] + '.fnlb'
         ahelpers.save_fnl(outname, ejc, head)
         print "Ejecta field saved to file {}".format(os.path.relpath(outname))
         print "Elapsed time = {:g} sec.".format(time() - tic)
@@ -75,7 +88,7 @@ def _PCL():
     known_methods = ['jutzi', 'naor1']
     parser = argparse.ArgumentParser()
     parser.add_argument('filename',
-        help="name of file containing node list data to ejectify")
+        help="name of file containing node list data to ejectify, or run directory")
     parser.add_argument('-m','--method',
         help="choice of algorithm for bound mass detection",
         choices=known_methods,
@@ -89,6 +102,21 @@ def _PCL():
         type=str,
         choices=[','],
         default=None)
+    parser.add_argument('--tmin',
+        help="skip snapshots before this time (sec)",
+        type=float,
+        default=None)
+    parser.add_argument('--tmax',
+        help="skip snapshots after this time (sec)",
+        type=float,
+        default=None)
+    parser.add_argument('--stride',
+        help="use every STRIDE-th snapshot (after time selection)",
+        type=int,
+        default=1)
+    parser.add_argument('--cache',
+        help="keep decoded ascii snapshots in CACHE for faster re-reads",
+        default=None)
     args = parser.parse_args()
     return args
 
@@ -0,0 +1,151 @@
+#!/soft/scipy_0.13.0/CentOS_6/bin/python
+#---------------------------------------------------------------------------------
+# fnl2fnlb - a utility for converting ascii SPHERAL output (.fnl and .fnl.gz files)
+# to the binary columnar format (.fnlb), which is many times faster to load.
+#
+# Author: Naor Movshovitz (nmovshov at gee mail dot com)
+#---------------------------------------------------------------------------------
+import sys, os
+import numpy as np
+import argparse
+import ahelpers
+from time import time
+
+def _main():
+    """Entry point when used as command line utility (recommended)."""
+
+    # Parse command line arguments
+    args = _PCL()
+
+    # Collect ascii snapshots, skipping the shards of sharded snapshots (their
+    # manifest refers to them by name)
+    if os.path.isfile(args.dirname):
+        allfiles = [args.dirname]
+    else:
+        allfiles = []
+        for root, dirs, files in os.walk(args.dirname):
+            dirs[:] = [d for d in dirs if not d.endswith('.shards')]
+            allfiles += [os.path.join(root,fn) for fn in files if
+                         fn.endswith(('.fnl','.fnl.gz'))]
+        allfiles.sort()
+    if not args.force:
+        allfiles = [f for f in allfiles if not os.path.exists(fnlb_name(f))]
+    if len(allfiles) == 0:
+        print "{} does not contain any unconverted fnl or fnl.gz files.".format(
+            args.dirname)
+        return
+
+    # Convert in a pool of worker processes, one file per task
+    import multiprocessing
+    nbProcs = args.processes or ahelpers._nb_workers()
+    nbProcs = max(1, min(nbProcs, len(allfiles)))
+    print "Converting {} files using {} processes.".format(len(allfiles), nbProcs)
+    print
+    ot = time()
+    nbFailed = 0
+    pool = multiprocessing.Pool(nbProcs)
+    try:
+        tasks = [(f, args.delete, args.precision) for f in allfiles]
+        for (onefile, nbNodes, err) in pool.imap_unordered(_convert_task, tasks):
+            if err is None:
+                print "{} -> {} ({} nodes).".format(os.path.relpath(onefile),
+                    os.path.basename(fnlb_name(onefile)), nbNodes)
+            else:
+                nbFailed += 1
+                print "FAILED {}: {}".format(os.path.relpath(onefile), err)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Finish and exit
+    print
+    print "{} files converted, {} failed. Elapsed time = {:g} sec.".format(
+        len(allfiles) - nbFailed, nbFailed, time() - ot)
+    if nbFailed:
+        sys.exit(1)
+    return
+
+def convert_fnl(filename, delete=False, precision=None):
+    """Convert one ascii snapshot to .fnlb, verify it, and optionally delete it.
+
+    The binary file is written next to filename, with the .fnl or .fnl.gz
+    extension replaced by .fnlb. It is first written under a temporary name and
+    read back, and only if all columns match the ascii data exactly (after the
+    stable grouping of rows by node list that the binary format uses) is it
+    renamed into place and, if delete=True, the original removed. The step and
+    time encoded in the standard output file names are copied into the binary
+    header. The free-text ascii header is not kept. With precision='single' (or
+    'half') the float columns are stored as float32 (or float16) and compared to
+    the ascii data rounded the same way. Half precision keeps only 3 significant
+    digits and turns values past 65504 into inf, so it rarely suits a whole
+    snapshot.
+
+    Returns the number of nodes converted; raises StandardError on failure.
+    """
+
+    outname = fnlb_name(filename)
+    tmpname = os.path.join(os.path.dirname(outname),
+                           '.tmp-' + os.path.basename(outname))
+    (step, stime) = ahelpers._name_step_time(filename)
+    types = ahelpers._fnlb_types(precision)
+    fnl = ahelpers.load_fnl(filename)
+    try:
+        ahelpers.save_fnl(tmpname, fnl, step=step, time=stime,
+                          precision=precision)
+        bfnl = ahelpers.load_fnl(tmpname)
+        order = np.argsort(fnl.id, kind='mergesort')
+        if bfnl.nbNodes != fnl.nbNodes:
+            raise StandardError("node count mismatch")
+        for (name, c) in zip(ahelpers.FNLMeta.col_names, types):
+            a = np.asarray(getattr(fnl, name))[order]
+            a = a.astype(c).astype(a.dtype)
+            b = np.asarray(getattr(bfnl, name), dtype=a.dtype)
+            if not np.all((a == b) | (np.isnan(a) & np.isnan(b))):
+                raise StandardError("column {} does not round-trip".format(name))
+        os.rename(tmpname, outname)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+    if delete:
+        os.remove(filename)
+    return fnl.nbNodes
+
+def fnlb_name(filename):
+    """The name of the .fnlb file converted from ascii file filename."""
+    for ext in ['.fnl.gz', '.fnl']:
+        if filename.endswith(ext):
+            return filename[:-len(ext)] + ahelpers.FNLBMeta.extension
+    return filename + ahelpers.FNLBMeta.extension
+
+def _convert_task(task):
+    (filename, delete, precision) = task
+    try:
+        return (filename, convert_fnl(filename, delete, precision), None)
+    except Exception as e:
+        return (filename, 0, str(e) or type(e).__name__)
+
+def _PCL():
+    parser = argparse.ArgumentParser(
+        description="convert .fnl/.fnl.gz snapshots to binary .fnlb")
+    parser.add_argument('dirname',
+        help="run output directory (searched recursively) or single file")
+    parser.add_argument('-p','--processes',
+        help="number of worker processes (default: one per cpu)",
+        type=int,
+        default=0)
+    parser.add_argument('--delete',
+        help="delete each original file after its conversion is verified",
+        action='store_true')
+    parser.add_argument('--precision',
+        help="precision of the stored float columns (default: double)",
+        choices=['double','single','half'],
+        default='double')
+    parser.add_argument('-f','--force',
+        help="convert files even if a .fnlb of the same name exists",
+        action='store_true')
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    _main()
+    pass
@@ -7,33 +7,41 @@
 import sys
 import numpy as np
 import argparse
+import ahelpers
 
 cout = sys.stdout.write
 parser = argparse.ArgumentParser()
 parser.add_argument('filename', help="name of file containing node list data")
 parser.add_argument('-pr', '--print_radii', action='store_true',
     help="attempt to identify mean radii, assuming spherical geometry")
+parser.add_argument('--chunk', type=int, default=100000,
+    help="number of nodes to hold in memory at a time")
 args = parser.parse_args()
 
 # Load node list data
 cout("Reading file...")
 try:
-    # FNL structure as it is in 2015-05-01
-    raw = np.loadtxt(args.filename)
+    # Reduce chunk by chunk, so memory use does not grow with file size
+    nb_nodes = {}
+    mass = {}
+    pmin = {}
+    pmax = {}
+    for chunk in ahelpers.iter_fnl_chunks(args.filename, args.chunk,
+                                          columns=['id','x','y','z','m']):
+        pos = np.vstack((chunk.x, chunk.y, chunk.z)).T
+        for n in np.unique(chunk.id):
+            ind = chunk.id == n
+            nb_nodes[n] = nb_nodes.get(n, 0) + ind.sum()
+            mass[n] = mass.get(n, 0.0) + chunk.m[ind].sum()
+            pmin[n] = np.minimum(pmin.get(n, np.inf), pos[ind].min(0))
+            pmax[n] = np.maximum(pmax.get(n, -np.inf), pos[ind].max(0))
     cout("Done.\n")
-    nl_id = raw[:,0]
-    pos = raw[:,2:5]
-    vel = raw[:,5:8]
-    m   = raw[:,8]
     print "Found {} nodes in {} node lists totaling {} kg.".format(
-        nl_id.size, np.unique(nl_id).size, sum(m))
-    for n in np.unique(nl_id):
-        body_nodes = sum(nl_id == n)
-        body_mass = sum(m[nl_id == n])
-        body_pos = pos[nl_id == n]
-        rx = (body_pos[:,0].max() - body_pos[:,0].min())/2
-        ry = (body_pos[:,1].max() - body_pos[:,1].min())/2
-        rz = (body_pos[:,2].max() - body_pos[:,2].min())/2
+        sum(nb_nodes.values()), len(nb_nodes), sum(mass.values()))
+    for n in sorted(nb_nodes.keys()):
+        body_nodes = nb_nodes[n]
+        body_mass = mass[n]
+        rx, ry, rz = (pmax[n] - pmin[n])/2
         body_r = (rx + ry + rz)/3
         print "    List {:g}: {:.6g} kg in {} nodes ({:.4g} kg/node).".format(
             n, body_mass, body_nodes, body_mass/body_nodes)
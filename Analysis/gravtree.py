@@ -0,0 +1,235 @@
+#-------------------------------------------------------------------------------
+#   Gravity Tree - Barnes-Hut octree evaluation of the gravitational potential
+#                  of a cloud of point masses, in O(N log N) instead of O(N^2).
+#
+# Author: nmovshov at gmail dot com
+#-------------------------------------------------------------------------------
+import numpy as np
+from numba import jit
+
+def tree_potential(x, y, z, m, mask=None, theta=0.5, leaf_size=8):
+    """Potential per unit G of a cloud of point masses, using an octree.
+
+    Returns (U, dU), where U[j] approximates -sum(m[k]/|r[j] - r[k]|) over all
+    k != j, exactly as bound_mass._c_potential does (with the same 1e-12
+    softening), and dU[j] is an upper bound on the error |U[j] - U_exact[j]|. If
+    mask is given only the masked particles attract and only their potential is
+    computed; the others get U = dU = 0.
+
+    The particles are sorted along a Morton curve and split into an octree, down
+    to leaves of at most leaf_size particles (or 21 levels). Each cell has its
+    mass, center of mass and the radius b of a sphere about its center of mass
+    holding all its particles. Walking the tree from the root, a cell at distance
+    d > b/theta from a particle acts on it as a point mass at its center of mass;
+    otherwise it is opened, and the particles of an opened leaf act directly.
+    Since the dipole moment about the center of mass vanishes, each such point
+    mass is off by at most M*b^2/(d^2*(d - b)), and dU is the sum of these bounds.
+    The opening angle theta must be in [0, 1). Smaller is slower and more
+    accurate, and theta=0 opens every cell, giving the exact sum. The bound is
+    a worst case; the actual error is typically much smaller. To measure it, use
+    potential_error.
+    """
+
+    # Minimal input control
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    z = np.ascontiguousarray(z, dtype=np.float64)
+    m = np.ascontiguousarray(m, dtype=np.float64)
+    assert x.ndim == 1 and x.shape == y.shape == z.shape == m.shape
+    assert 0 <= theta < 1, "opening angle must be in [0, 1)"
+    assert leaf_size >= 1
+    if mask is None:
+        ind = np.arange(len(x))
+    else:
+        ind = np.flatnonzero(mask)
+    U = np.zeros(len(x))
+    dU = np.zeros(len(x))
+    if len(ind) == 0:
+        return (U, dU)
+
+    # Sort the attracting particles along a Morton curve
+    (px, py, pz, pm) = (x[ind], y[ind], z[ind], m[ind])
+    lo = min(px.min(), py.min(), pz.min())
+    span = max(px.max(), py.max(), pz.max()) - lo
+    if not span > 0:
+        span = 1.0
+    scale = (2**21 - 1)/span
+    keys = _c_morton_keys(((px - lo)*scale).astype(np.int64),
+                          ((py - lo)*scale).astype(np.int64),
+                          ((pz - lo)*scale).astype(np.int64))
+    order = np.argsort(keys, kind='mergesort')
+    (keys, px, py, pz, pm) = (keys[order], px[order], py[order], pz[order],
+                              pm[order])
+
+    # Build the tree, with room for more cells if needed
+    cap = 2*(len(px)//leaf_size) + 64
+    while True:
+        tree = _c_build_tree(keys, px, py, pz, pm, leaf_size, cap)
+        if tree[0] >= 0:
+            break
+        cap *= 2
+
+    # Walk it for every particle
+    (Us, dUs) = _c_walk_tree(px, py, pz, pm, theta, *tree[1:])
+    U[ind[order]] = Us
+    dU[ind[order]] = dUs
+    return (U, dU)
+
+def potential_error(x, y, z, m, U, mask=None, nb_samples=64):
+    """Largest relative error of a potential U among randomly sampled particles.
+
+    The exact potential of nb_samples randomly chosen particles (masked ones, if
+    mask is given) is found by direct summation, in O(nb_samples*N), and compared
+    with U. The random choice is repeatable.
+    """
+
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    z = np.ascontiguousarray(z, dtype=np.float64)
+    m = np.ascontiguousarray(m, dtype=np.float64)
+    if mask is None:
+        mask = np.ones(len(x), dtype=bool)
+    ind = np.flatnonzero(mask)
+    if len(ind) == 0:
+        return 0.0
+    if len(ind) > nb_samples:
+        ind = np.random.RandomState(0).choice(ind, nb_samples, replace=False)
+    Ue = _c_direct_potential(x, y, z, m, np.asarray(mask, dtype=bool), ind)
+    return np.max(np.abs(np.asarray(U)[ind] - Ue)/np.abs(Ue))
+
+@jit(nopython=True)
+def _c_direct_potential(x, y, z, m, mask, ind):
+    U = np.zeros(len(ind))
+    for i in range(len(ind)):
+        j = ind[i]
+        for k in range(len(x)):
+            if mask[k] and k != j:
+                dx = x[j] - x[k]
+                dy = y[j] - y[k]
+                dz = z[j] - z[k]
+                U[i] -= m[k]/(np.sqrt(dx*dx + dy*dy + dz*dz) + 1e-12)
+    return U
+
+@jit(nopython=True)
+def _c_morton_keys(qx, qy, qz):
+    keys = np.zeros(qx.shape, dtype=np.int64)
+    for j in range(len(qx)):
+        key = 0
+        for bit in range(21):
+            key |= ((qx[j] >> bit) & 1) << (3*bit + 2)
+            key |= ((qy[j] >> bit) & 1) << (3*bit + 1)
+            key |= ((qz[j] >> bit) & 1) << (3*bit)
+        keys[j] = key
+    return keys
+
+@jit(nopython=True)
+def _c_build_tree(keys, x, y, z, m, leaf, cap):
+    # Cells are created breadth first, so the children of a cell are consecutive.
+    # Returns -1 for the number of cells if cap is too small.
+    start = np.zeros(cap, dtype=np.int64)
+    end = np.zeros(cap, dtype=np.int64)
+    level = np.zeros(cap, dtype=np.int64)
+    first = np.zeros(cap, dtype=np.int64)
+    nchild = np.zeros(cap, dtype=np.int64)
+    mass = np.zeros(cap)
+    cx = np.zeros(cap)
+    cy = np.zeros(cap)
+    cz = np.zeros(cap)
+    size = np.zeros(cap)
+    end[0] = len(x)
+    nb = 1
+    i = 0
+    while i < nb:
+        a = start[i]
+        b = end[i]
+        if b - a > leaf and level[i] < 21:
+            shift = 3*(20 - level[i])
+            first[i] = nb
+            k = a
+            while k < b:
+                c = (keys[k] >> shift) & 7
+                k2 = k + 1
+                while k2 < b and ((keys[k2] >> shift) & 7) == c:
+                    k2 += 1
+                if nb == cap:
+                    return (-1, start, end, first, nchild, mass, cx, cy, cz, size)
+                start[nb] = k
+                end[nb] = k2
+                level[nb] = level[i] + 1
+                nb += 1
+                k = k2
+            nchild[i] = nb - first[i]
+        i += 1
+
+    # Moments, children before parents. The radius of a parent is bounded by
+    # those of its children, which keeps the error bound valid.
+    for i in range(nb - 1, -1, -1):
+        M = 0.0
+        sx = 0.0
+        sy = 0.0
+        sz = 0.0
+        if nchild[i] == 0:
+            for k in range(start[i], end[i]):
+                M += m[k]
+                sx += m[k]*x[k]
+                sy += m[k]*y[k]
+                sz += m[k]*z[k]
+        else:
+            for c in range(first[i], first[i] + nchild[i]):
+                M += mass[c]
+                sx += mass[c]*cx[c]
+                sy += mass[c]*cy[c]
+                sz += mass[c]*cz[c]
+        mass[i] = M
+        cx[i] = sx/M
+        cy[i] = sy/M
+        cz[i] = sz/M
+        b = 0.0
+        if nchild[i] == 0:
+            for k in range(start[i], end[i]):
+                d = np.sqrt((x[k] - cx[i])**2 + (y[k] - cy[i])**2 +
+                            (z[k] - cz[i])**2)
+                b = max(b, d)
+        else:
+            for c in range(first[i], first[i] + nchild[i]):
+                d = np.sqrt((cx[c] - cx[i])**2 + (cy[c] - cy[i])**2 +
+                            (cz[c] - cz[i])**2)
+                b = max(b, d + size[c])
+        size[i] = b
+    return (nb, start, end, first, nchild, mass, cx, cy, cz, size)
+
+@jit(nopython=True)
+def _c_walk_tree(x, y, z, m, theta, start, end, first, nchild, mass, cx, cy, cz,
+                 size):
+    U = np.zeros(x.shape)
+    dU = np.zeros(x.shape)
+    stack = np.zeros(8*23, dtype=np.int64)
+    for j in range(len(x)):
+        u = 0.0
+        e = 0.0
+        stack[0] = 0
+        sp = 1
+        while sp > 0:
+            sp -= 1
+            i = stack[sp]
+            dx = x[j] - cx[i]
+            dy = y[j] - cy[i]
+            dz = z[j] - cz[i]
+            d = np.sqrt(dx*dx + dy*dy + dz*dz)
+            if size[i] < theta*d:
+                u -= mass[i]/(d + 1e-12)
+                e += mass[i]*size[i]*size[i]/(d*d*(d - size[i]))
+            elif nchild[i] == 0:
+                for k in range(start[i], end[i]):
+                    if k != j:
+                        dx = x[j] - x[k]
+                        dy = y[j] - y[k]
+                        dz = z[j] - z[k]
+                        u -= m[k]/(np.sqrt(dx*dx + dy*dy + dz*dz) + 1e-12)
+            else:
+                for c in range(first[i], first[i] + nchild[i]):
+                    stack[sp] = c
+                    sp += 1
+        U[j] = u
+        dU[j] = e
+    return (U, dU)
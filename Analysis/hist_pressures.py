@@ -6,27 +6,37 @@ import sys, os
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
-pcsbase = '' # Edit this with full path to <pcs> if you see an ImportError.
-sys.path += ['..',pcsbase,os.getenv('PCSBASE','')]
-import shelpers
+import ahelpers
 
 if len(sys.argv)==1:
     sys.exit("Please provide file name as first parameter")
 
-nodes = np.loadtxt(sys.argv[1])
-if (nodes.ndim != 2) or (nodes.shape[1] != shelpers.nb_fnl_columns):
+# Two passes over the file, chunk by chunk, so memory use stays constant: one to
+# find the range of pressures and one to count them in bins.
+nbins = 10
+try:
+    Pmin, Pmax = np.inf, -np.inf
+    for chunk in ahelpers.iter_fnl_chunks(sys.argv[1], columns=['P']):
+        Pmin = min(Pmin, chunk.P.min())
+        Pmax = max(Pmax, chunk.P.max())
+    if Pmin == Pmax:
+        Pmin, Pmax = Pmin - 0.5, Pmax + 0.5
+    counts = np.zeros(nbins)
+    edges = np.linspace(Pmin, Pmax, nbins + 1)
+    for chunk in ahelpers.iter_fnl_chunks(sys.argv[1], columns=['P']):
+        counts += np.histogram(chunk.P, edges)[0]
+except StandardError:
     sys.exit("{} does not appear to contain a valid flattened node list".format(
              sys.argv[1]))
 
 print "Plotting nodes from file", sys.argv[1]
-P = nodes[:,10] * 1e-9 # pressure in GPa
+edges = edges * 1e-9 # pressure in GPa
 
 plt.figure()
-plt.hist(P,)
+plt.hist(edges[:-1], edges, weights=counts)
 plt.xlabel('Pressure [GPa]')
 plt.ylabel('Count')
 plt.title(sys.argv[1])
 plt.grid()
 plt.show()
 print "Done."
-
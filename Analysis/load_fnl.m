@@ -15,7 +15,8 @@ end
 % Load and distribute data
 raw = importdata(filename,' ',headcount(filename));
 varNames = {'id', 'eos_id', 'x', 'y', 'z', 'vx', 'vy', 'vz', 'm', 'rho',...
-            'P', 'T', 'U', 'hmin', 'hmax'};
+            'P', 'T', 'U', 'hmin', 'hmax', 'gid'};
+varNames = varNames(1:size(raw.data,2)); % files from before gid have 15 columns
 if verLessThan('matlab','8.4.0')
     fnl = raw.data;
 else
@@ -3,6 +3,9 @@
 #include<stdlib.h>
 #include<math.h>
 
+/* data lines are 201 characters since the gid column was added */
+#define LINELEN 512
+
 /* little program that reads particle info from the SPHERAL output files that 
 * Naor Movshovitz has formatted and classifies them by equivalence class
 * per Numerical recipes */  
@@ -34,7 +37,7 @@ main(int argc, char *argv[]) {
 	double Gphitotal, Mtotal;
 
 	char file[80];
-        char line[200];
+        char line[LINELEN];
 	char string1[132], string2[132];
         FILE *fp, *out;
 
@@ -53,41 +56,18 @@ main(int argc, char *argv[]) {
 
         fp = fopen(file, "r");
 
-/* the format seems to have 26 header lines */
-	nhead = 26;
-
-/* start to read header lines */
-	ihead = 1;
+/* header lines start with '#' (26 of them in 15-column files, 29 since the
+* gid column was added); count them and the data lines */
+	nhead = 0;
 	iline = 0;
-
-	while (iline < nhead) {
-		fgets(line,200,fp);
-/*		printf("line read: %s",line);  */
-		if (iline == 1) {
-			ihead = strncmp(line,begin_head_string,3);
-			if (ihead == 0) {
-			printf("begin header %s detected on line : %d\n",
-				line,iline); 
-			}
-
-		}
-		if (iline == nhead-1 ) {
-			ihead = strncmp(line,end_head_string,3);
-			if (ihead == 0) {
-			printf("end header %s detected on line : %d\n",
-				line,iline); 
-			}
+	while(fgets(line,LINELEN,fp) != NULL) {
+		if (iline == 0 && line[0] == '#') {
+			nhead++;
+		} else {
+			iline++;
 		}
-		iline++;
-
-	}
-
-	iline = 0;
-
-/* count lines */
-	while(fgets(line,200,fp) != NULL) {
-		iline++;
 	}
+	printf("number of header lines = %d\n",nhead);
         fclose(fp);
 	printf("number of data lines = %d\n",iline);
 
@@ -99,6 +79,7 @@ main(int argc, char *argv[]) {
 	double vx[npt], vy[npt], vz[npt];
 	double mass[npt], rho[npt], p[npt], T[npt], U[npt];
 	double hmin[npt], hmax[npt];
+	int gid[npt];
 
 /* particle data for members in the biggest group */
 	double phig[npt], zkeg[npt];
@@ -109,14 +90,12 @@ main(int argc, char *argv[]) {
 /* reopen and re-read file */
        fp = fopen(file, "r");
 
-/* the format seems to have 26 header lines */
-
 /* start to read header lines */
         ihead = 1;
         iline = 0;
 
         while (iline < nhead) {
-                fgets(line,200,fp);
+                fgets(line,LINELEN,fp);
 /*              printf("line read: %s",line);  */
                 if (iline == 1) {
                         ihead = strncmp(line,begin_head_string,3);
@@ -139,11 +118,13 @@ main(int argc, char *argv[]) {
 
         i = 0;
 /* read lines */
-        while(fgets(line,200,fp) != NULL) {
+/* gid (the 16th column) stays -1 in files written without it */
+        while(fgets(line,LINELEN,fp) != NULL) {
+		gid[i] = -1;
 		sscanf(line,"%d %d %lf %lf %lf %lf %lf %lf %lf %lf %lf \
-                    %lf %lf %lf %lf %lf", &id[i],&id_eos[i],&x[i],&y[i],&z[i],
+                    %lf %lf %lf %lf %d", &id[i],&id_eos[i],&x[i],&y[i],&z[i],
                         &vx[i],&vy[i],&vz[i],&mass[i],&rho[i],&p[i],&T[i],&U[i],
-			&hmin[i],&hmax[i]);
+			&hmin[i],&hmax[i],&gid[i]);
 		i++;
         }
         fclose(fp);
@@ -6,12 +6,13 @@ import sys, os
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+import ahelpers
 
 if len(sys.argv)==1:
     sys.exit("ERROR: provide file name as first parameter.")
 
-nodes = np.loadtxt(sys.argv[1])
-if (nodes.ndim != 2) or (nodes.shape[1] != 15):
+nodes = ahelpers.read_fnl_table(sys.argv[1])
+if (nodes.ndim != 2) or (nodes.shape[1] != ahelpers.FNLMeta.nb_columns):
     sys.exit("{} does not appear to contain a valid flattened node list".format(
              sys.argv[1]))
 
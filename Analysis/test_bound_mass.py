@@ -0,0 +1,174 @@
+#---------------------------------------------------------------------------------
+# test_bound_mass - regression tests of the vectorized bound_mass methods against
+# the original per-node loops.
+#
+# Run with: python test_bound_mass.py (or python -m unittest test_bound_mass)
+#---------------------------------------------------------------------------------
+import unittest
+import numpy as np
+import bound_mass as bm
+
+bigG = 6.67384e-11
+
+def _cloud(n, seed):
+    """A bound clump, a smaller clump moving away, and fast debris."""
+    rs = np.random.RandomState(seed)
+    (n1, n2) = (n//2, n//4)
+    n3 = n - n1 - n2
+    pos = np.vstack((rs.randn(n1,3)*1e5, rs.randn(n2,3)*3e4 + [4e5,0,0],
+                     rs.uniform(-2e6, 2e6, (n3,3))))
+    vel = np.vstack((rs.randn(n1,3)*rs.uniform(0.1, 20, (n1,1)),
+                     rs.randn(n2,3)*5 + [30,0,0], rs.randn(n3,3)*200))
+    m = rs.uniform(0.5, 1.5, n)*1e15
+    return (pos, vel, m)
+
+def loop_kory1(pos, vel, m, bigG):
+    U = bigG*bm._potential(pos[:,0], pos[:,1], pos[:,2], m)
+    VCM = vel[np.argmin(U),:]
+    ind_bound = np.array(len(m)*[False])
+    for j in range(len(m)):
+        V = vel[j,:] - VCM
+        K = 0.5*(V[0]*V[0] + V[1]*V[1] + V[2]*V[2])
+        if K + U[j] < 0:
+            ind_bound[j] = True
+    return ind_bound
+
+def loop_kory2(pos, vel, m, bigG):
+    # The loop version never updated its best mass, so this is the intended
+    # method written out per node: the first frame with the most bound mass.
+    U = bigG*bm._potential(pos[:,0], pos[:,1], pos[:,2], m)
+    frames = np.argsort(U, kind='mergesort')
+    max_M = -np.inf
+    for j in frames:
+        mask = np.array(len(m)*[False])
+        for k in range(len(m)):
+            V = vel[k,:] - vel[j,:]
+            K = 0.5*(V[0]*V[0] + V[1]*V[1] + V[2]*V[2])
+            mask[k] = K + U[k] < 0
+        M = np.sum(m[mask])
+        if M > max_M:
+            (max_M, ind_bound) = (M, mask)
+    return ind_bound
+
+def loop_jutzi(pos, vel, m, bigG, maxiter):
+    bU = bigG*bm._potential(pos[:,0], pos[:,1], pos[:,2], m)
+    VCM = vel[np.argmin(bU),:]
+    ind_bound = np.array(len(m)*[True])
+    nbb = -1
+    citer = 0
+    while (nbb != sum(ind_bound)) and (citer < maxiter):
+        citer += 1
+        nbb = sum(ind_bound)
+        bU = bigG*bm._potential(pos[:,0], pos[:,1], pos[:,2], m, ind_bound)
+        for j in range(len(m)):
+            V = vel[j,:] - VCM
+            K = 0.5*(V[0]*V[0] + V[1]*V[1] + V[2]*V[2])
+            if K + bU[j] > 0.0:
+                ind_bound[j] = False
+    return ind_bound
+
+def loop_naor(pos, vel, m, bigG, maxiter, ind):
+    ind_bound = np.array(len(m)*[False])
+    ind_bound[ind] = True
+    nbb = -1
+    citer = 0
+    m3 = np.tile(m,(3,1)).T
+    while (nbb != sum(ind_bound)) and (citer < maxiter):
+        citer += 1
+        nbb = sum(ind_bound)
+        M = sum(m[ind_bound])
+        cmpos = np.sum(m3[ind_bound,:]*pos[ind_bound,:], 0)/M
+        cmvel = np.sum(m3[ind_bound,:]*vel[ind_bound,:], 0)/M
+        for j in range(len(m)):
+            dR = pos[j,:] - cmpos
+            dr = np.sqrt(np.dot(dR, dR)) + np.spacing(1)
+            U = -bigG*M/dr
+            V = vel[j,:] - cmvel
+            K = 0.5*(V[0]*V[0] + V[1]*V[1] + V[2]*V[2])
+            ind_bound[j] = K + U < 0.0
+    return ind_bound
+
+def loop_naor3_seed(pos, m):
+    cmpos = np.sum(np.tile(m,(3,1)).T*pos, 0)/sum(m)
+    dR = np.inf
+    for k in range(len(m)):
+        dr = cmpos - pos[k]
+        dr = np.sqrt(dr.dot(dr))
+        if dr < dR:
+            dR = dr
+            ind = k
+    return ind
+
+class TestVectorized(unittest.TestCase):
+    """The vectorized methods must return the same bound masks as the loops."""
+
+    n = 2000
+    seeds = (0, 1, 2)
+
+    def assertSameMask(self, new, old, name, seed):
+        self.assertTrue(np.array_equal(new, old),
+            "seed {} {}: {} of {} nodes differ".format(seed, name,
+                np.count_nonzero(new != old), len(old)))
+        self.assertTrue(0 < np.count_nonzero(old) < len(old),
+            "seed {} {}: trivial mask".format(seed, name))
+
+    def test_kory1(self):
+        for seed in self.seeds:
+            (pos, vel, m) = _cloud(self.n, seed)
+            self.assertSameMask(bm._bm_kory1(pos, vel, m, bigG)[1],
+                                loop_kory1(pos, vel, m, bigG), 'kory1', seed)
+
+    def test_kory2(self):
+        # All frames are tried by the loop, so keep the cloud small
+        for seed in self.seeds:
+            (pos, vel, m) = _cloud(200, seed)
+            old = loop_kory2(pos, vel, m, bigG)
+            for processes in (1, 2):
+                new = bm._bm_kory2(pos, vel, m, bigG, candidates=0,
+                                   processes=processes)[1]
+                self.assertSameMask(new, old,
+                    'kory2 (processes={})'.format(processes), seed)
+
+    def test_jutzi(self):
+        for seed in self.seeds:
+            (pos, vel, m) = _cloud(self.n, seed)
+            old = loop_jutzi(pos, vel, m, bigG, 20)
+            self.assertSameMask(bm._bm_jutzi(pos, vel, m, bigG, 20)[1],
+                                old, 'jutzi', seed)
+            self.assertSameMask(
+                bm._bm_jutzi(pos, vel, m, bigG, 20, incremental=True)[1],
+                old, 'jutzi (incremental)', seed)
+            self.assertSameMask(
+                bm._bm_jutzi(pos, vel, m, bigG, 20, incremental=True,
+                             refresh=2)[1],
+                old, 'jutzi (incremental, refresh=2)', seed)
+
+    def test_naor1(self):
+        for seed in self.seeds:
+            (pos, vel, m) = _cloud(self.n, seed)
+            U = bigG*bm._potential(pos[:,0], pos[:,1], pos[:,2], m)
+            self.assertSameMask(bm._bm_naor1(pos, vel, m, bigG, 20)[1],
+                loop_naor(pos, vel, m, bigG, 20, np.argmin(U)), 'naor1', seed)
+
+    def test_naor3(self):
+        for seed in self.seeds:
+            (pos, vel, m) = _cloud(self.n, seed)
+            self.assertSameMask(bm._bm_naor3(pos, vel, m, bigG, 20)[1],
+                loop_naor(pos, vel, m, bigG, 20, loop_naor3_seed(pos, m)),
+                'naor3', seed)
+
+    def test_norm2(self):
+        # The naor loops use np.dot(dR, dR), which may add the squares in
+        # another order (or fused) than _norm2 does. They must agree to roundoff;
+        # test_naor1 and test_naor3 check that this never decides a node.
+        for seed in self.seeds:
+            (pos, vel, m) = _cloud(self.n, seed)
+            R0 = np.mean(pos, 0)
+            new = bm._norm2(pos, R0)
+            old = np.array([np.dot(dR, dR) for dR in pos - R0])
+            self.assertTrue(np.all(np.abs(new - old) <= 4*np.spacing(old)))
+            self.assertEqual(np.argmin(new), np.argmin(old))
+
+if __name__ == "__main__":
+    unittest.main()
+    pass
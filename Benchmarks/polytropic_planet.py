@@ -367,7 +367,9 @@ mOutput(control.totalSteps, control.time(), control.lastDt())
 # Print current planet's vitals and compare to expected solution.
 if polytrope_n == 1:
     # Approximate planet's vitals via nearest node
+    # (the dict is gathered in rank 0 only)
     mdict = shelpers.spickle_node_list(planet,silent=True)
+if polytrope_n == 1 and mpi.rank == 0:
     plan_arr = max([hypot(x[0],hypot(x[1],x[2])) for x in mdict['x']])
     plan_arr += max([max(x) for x in mdict['h']])
     plan_rho = max(mdict['rho'])
@@ -67,6 +67,10 @@ vizTime = 0.2*goalTime       # Time frequency for dropping viz files (sec)
 vizCycle = None              # Cycle frequency for dropping viz files
 outTime = vizTime            # Time between running output routine (sec)
 outCycle = None              # Cycles between running output routine
+outFormat = 'fnl.gz'         # Snapshot format: 'fnl'|'fnl.gz'|'fnlb'|'h5'|'fnls'
+outShards = False            # Write one snapshot file per rank plus a manifest
+outBackground = False        # Write snapshots in a background thread while stepping
+outPrecision = 'double'      # Binary snapshot floats: 'double'|'single'|'half'
 
 # Node list parameters
 nPerh = 2.01                 # Nominal number of nodes per smoothing scale
@@ -119,6 +123,9 @@ assert vImpact >= 0.
 assert 0 <= angleImpact < 90, "give impact angle in first quadrant (in degrees)"
 assert (outTime is None) or (outCycle is None),\
         "output on both time and cycle is confusing"
+assert outFormat in ['fnl', 'fnl.gz', 'fnlb', 'h5', 'fnls'],\
+        "unknown output format"
+assert not (outShards and outFormat == 'fnls'), "time series can't be sharded"
 assert generator_type in ['hcp', 'shells', 'old']
 if cooldownFrequency is not None:
     sys.stderr.write("\033[1;31m")
@@ -384,6 +391,9 @@ if restoreCycle is None:
         nGlobalNodes += mpi.allreduce(n.numInternalNodes, mpi.SUM)
     del n
     print "Total number of (internal) nodes in simulation: ", nGlobalNodes
+
+    # Number the nodes so snapshots can be matched node by node (lost on restart).
+    shelpers.assign_global_node_ids(nodeSet)
     WMR = (max(impactor.mass().max(), target.mass().max())/
            min(impactor.mass().min(), target.mass().min()))
     if WMR < 1.5:
@@ -480,8 +490,13 @@ control = SpheralController(integrator, WT,
 #-------------------------------------------------------------------------------
 def mOutput(stepsSoFar,timeNow,dt):
     mFileName="{0}-{1:05d}-{2:g}.{3}".format(
-              jobName, stepsSoFar, timeNow, 'fnl.gz')
-    shelpers.pflatten_node_list_list(nodeSet, outDir + '/' + mFileName)
+              jobName, stepsSoFar, timeNow, outFormat)
+    if outFormat == 'fnls': # all snapshots go to one time series file
+        mFileName = jobName + '.fnls'
+    shelpers.pflatten_node_list_list(nodeSet, outDir + '/' + mFileName,
+                                     step=stepsSoFar, time=timeNow,
+                                     shards=outShards, background=outBackground,
+                                     precision=outPrecision)
     pass
 if not outCycle is None:
     control.appendPeriodicWork(mOutput,outCycle)
@@ -574,6 +589,7 @@ else:
 #-------------------------------------------------------------------------------
 # Save final state in a flattened node list (.fnl) file.
 mOutput(control.totalSteps, control.time(), control.lastDt())
+shelpers.wait_for_background_output()
 
 #-------------------------------------------------------------------------------
 # NAV Final thoughts
@@ -63,6 +63,10 @@ vizTime = 0.2*goalTime       # Time frequency for dropping viz files (sec)
 vizCycle = None              # Cycle frequency for dropping viz files
 outTime = vizTime            # Time between running output routine (sec)
 outCycle = None              # Cycles between running output routine
+outFormat = 'fnl.gz'         # Snapshot format: 'fnl'|'fnl.gz'|'fnlb'|'h5'|'fnls'
+outShards = False            # Write one snapshot file per rank plus a manifest
+outBackground = False        # Write snapshots in a background thread while stepping
+outPrecision = 'double'      # Binary snapshot floats: 'double'|'single'|'half'
 
 # Node list parameters
 nPerh = 2.01                 # Nominal number of nodes per smoothing scale
@@ -111,6 +115,9 @@ if cooldownFrequency is not None:
             "dashpot cooling method requires frequency=1"
 assert (outTime is None) or (outCycle is None),\
         "output on both time and cycle is confusing"
+assert outFormat in ['fnl', 'fnl.gz', 'fnlb', 'h5', 'fnls'],\
+        "unknown output format"
+assert not (outShards and outFormat == 'fnls'), "time series can't be sharded"
 assert rPlanet > rCore, "core means it's inside"
 assert generator_type in ['hcp',]
 
@@ -369,6 +376,9 @@ if restoreCycle is None:
         nGlobalNodes += mpi.allreduce(n.numInternalNodes, mpi.SUM)
     del n
     print "Total number of (internal) nodes in simulation: ", nGlobalNodes
+
+    # Number the nodes so snapshots can be matched node by node (lost on restart).
+    shelpers.assign_global_node_ids(nodeSet)
     
     pass # end restoreCycle branching
 
@@ -449,8 +459,13 @@ control = SpheralController(integrator, WT,
 #-------------------------------------------------------------------------------
 def mOutput(stepsSoFar,timeNow,dt):
     mFileName="{0}-{1:04d}-{2:g}.{3}".format(
-              jobName, stepsSoFar, timeNow, 'fnl.gz')
-    shelpers.pflatten_node_list_list(nodeSet, outDir + '/' + mFileName)
+              jobName, stepsSoFar, timeNow, outFormat)
+    if outFormat == 'fnls': # all snapshots go to one time series file
+        mFileName = jobName + '.fnls'
+    shelpers.pflatten_node_list_list(nodeSet, outDir + '/' + mFileName,
+                                     step=stepsSoFar, time=timeNow,
+                                     shards=outShards, background=outBackground,
+                                     precision=outPrecision)
     pass
 if not outCycle is None:
     control.appendPeriodicWork(mOutput,outCycle)
@@ -514,6 +529,7 @@ else:
 #-------------------------------------------------------------------------------
 # Save final state in a flattened node list (.fnl) file.
 mOutput(control.totalSteps, control.time(), control.lastDt())
+shelpers.wait_for_background_output()
 
 # Print current planet's (approximate) vitals.
 #TODO
@@ -5,6 +5,10 @@
 # Author: nmovshov at gmail dot com
 #-------------------------------------------------------------------------------
 import sys, os
+import struct
+import json
+import atexit
+import threading
 import mpi # Mike's simplified mpi wrapper
 import cPickle as pickle
 import numpy as np
@@ -447,16 +451,25 @@ def spickle_node_list(nl,filename=None,silent=False):
     (Note: This is not a true pickler class.)
 
     spickle_node_list(nl,filename) extracts field variables from all nodes of nl,
-    which must be a valid node list, and packs them in a dict that is returned
-    to the caller. If the optional argument filename is a string then dict will
-    also be pickled to a file of that name. The file will be overwritten if it
-    exists.
+    which must be a valid node list, and packs them in a dict of numpy arrays that
+    is returned to the caller in rank 0 (other ranks get None). The vector fields
+    x, v and h (the smoothing ellipsoid half-axes, in ascending order) are n-by-3
+    arrays, the others have length n, and the nodes are in rank order. If the
+    optional argument filename is a string then dict will also be pickled to a
+    file of that name, with the highest pickle protocol (which stores the arrays
+    as raw bytes) and with the eos id of the node list added as eos_id. The file
+    will be overwritten if it exists. If filename has the .npz extension the dict
+    is instead saved with np.savez, one array per field plus name, eos_id and
+    material. If filename has the .h5 extension the dict is instead saved as an
+    HDF5 file (requires h5py), one compressed dataset per field, with the node
+    list name, eos id and material tag as attributes. Load any of these with
+    ahelpers.load_spickle.
 
     The s in spickle is for 'serial', a reminder that this method collects all
-    nodes of the node list (from all ranks) in a single process. Thus this method
-    is mainly useful for interactive work with small node lists. It is the user's
-    responsibility to make sure her process has enough memory to hold the returned
-    dict.
+    nodes of the node list (from all ranks) in a single process. Each rank packs
+    its nodes in one typed array and only rank 0 receives them all (with
+    mpi4py's Gatherv if available), so only rank 0 needs the memory to hold the
+    returned dict. It is the user's responsibility to make sure it has enough.
 
     See also: pflatten_node_list
     """
@@ -471,65 +484,42 @@ def spickle_node_list(nl,filename=None,silent=False):
     if not silent:
         sys.stdout.write('Pickling ' +  nl.label() + ' ' + nl.name + '........')
 
-    # Get values of field variables stored in internal nodes.
-    xloc = nl.positions().internalValues()
-    vloc = nl.velocity().internalValues()
-    mloc = nl.mass().internalValues()
-    rloc = nl.massDensity().internalValues()
-    uloc = nl.specificThermalEnergy().internalValues()
-    Hloc = nl.Hfield().internalValues()
-    #(pressure and temperature are stored in the eos object.)
-    eos = nl.equationOfState()
-    ploc = sph.ScalarField('ploc',nl)
-    Tloc = sph.ScalarField('loc',nl)
-    rref = nl.massDensity()
-    uref = nl.specificThermalEnergy()
-    eos.setPressure(ploc,rref,uref)
-    eos.setTemperature(Tloc,rref,uref)
+    # Pack the fields of local nodes as the columns of one table, so that a
+    # single gather keeps all fields of a node in the same row.
+    fields = _local_field_arrays(nl)
+    local = np.column_stack([fields[key] for key in spickle_field_names])
+    table = _gather_rows(local)
 
-    # Zip fields so that we have all fields for each node in the same tuple.
-    #  We do this so we can concatenate everything in a single reduction operation,
-    #  to ensure that all fields in one record in the final list belong to the 
-    #  same node.
-    localFields = zip(xloc, vloc, mloc, rloc, uloc, ploc, Tloc, Hloc)
-
-    # Do a SUM reduction on all ranks.
-    #  This works because the + operator for python lists is a concatenation!
-    globalFields = mpi.allreduce(localFields, mpi.SUM)
-
-    # Create a dictionary to hold field variables.
-    nlFieldDict = dict(name=nl.name,
-                       x=[],   # position vector
-                       v=[],   # velocity vector
-                       m=[],   # mass
-                       rho=[], # mass density
-                       p=[],   # pressure
-                       h=[],   # smoothing ellipsoid axes
-                       T=[],   # temperature
-                       U=[],   # specific thermal energy
-                      )
-
-    # Loop over nodes to fill field values.
-    nbGlobalNodes = mpi.allreduce(nl.numInternalNodes, mpi.SUM)
-    for k in range(nbGlobalNodes):
-        nlFieldDict[  'x'].append((globalFields[k][0].x, globalFields[k][0].y, globalFields[k][0].z))
-        nlFieldDict[  'v'].append((globalFields[k][1].x, globalFields[k][1].y, globalFields[k][1].z))
-        nlFieldDict[  'm'].append( globalFields[k][2])
-        nlFieldDict['rho'].append( globalFields[k][3])
-        nlFieldDict[  'U'].append( globalFields[k][4])
-        nlFieldDict[  'p'].append( globalFields[k][5])
-        nlFieldDict[  'T'].append( globalFields[k][6])
-        nlFieldDict[  'h'].append((globalFields[k][7].Inverse().eigenValues().x,
-                                   globalFields[k][7].Inverse().eigenValues().y,
-                                   globalFields[k][7].Inverse().eigenValues().z,
-                                   ))
+    # Split the table into a dictionary of field variables, in rank 0.
+    if mpi.rank == 0:
+        nlFieldDict = dict(name=nl.name)
+        col = 0
+        for key in spickle_field_names:
+            width = 1 if fields[key].ndim == 1 else fields[key].shape[1]
+            if width == 1:
+                nlFieldDict[key] = table[:,col].copy()
+            else:
+                nlFieldDict[key] = table[:,col:col+width].copy()
+            col += width
+            pass
+        del table
+    else:
+        nlFieldDict = None
 
     # Optionally, pickle the dict to a file.
     if mpi.rank == 0:
         if filename is not None:
             if isinstance(filename, str):
-                with open(filename, 'wb') as fid:
-                    pickle.dump(nlFieldDict, fid)
+                eos_id = getattr(nl,'eos_id',-1)
+                if os.path.splitext(filename)[1] == h5_extension:
+                    _write_h5_dict(filename, nlFieldDict, eos_id=eos_id)
+                elif os.path.splitext(filename)[1] == npz_extension:
+                    _write_npz_dict(filename, nlFieldDict, eos_id=eos_id)
+                else:
+                    with open(filename, 'wb') as fid:
+                        pickle.dump(dict(nlFieldDict, eos_id=eos_id), fid,
+                                    pickle.HIGHEST_PROTOCOL)
+                        pass
                     pass
                 pass
             else:
@@ -547,6 +537,42 @@ def spickle_node_list(nl,filename=None,silent=False):
     # End function spickle_node_list
 
 
+def assign_global_node_ids(nls):
+    """Give every node of a list of node lists a persistent global id.
+
+    assign_global_node_ids(nls) numbers the internal nodes of all node lists in
+    nls consecutively from 0, list after list and, within a list, rank after
+    rank. The ids are kept in an int field, registered with each node list as
+    the attribute gid, so they travel with their nodes when nodes are
+    redistributed among ranks and are deleted with them. Call it once, after
+    the nodes are generated and distributed; all ranks must call it together.
+    Snapshots then carry the ids in their gid column (see pflatten_node_list),
+    and ahelpers.join_fnl matches the nodes of two snapshots with them.
+
+    Spheral does not know about this field, so it is not saved in restart files.
+    After a restart the node lists have no gid and snapshots get gid -1; ids are
+    not reassigned, which would give the same node a different id.
+    """
+
+    # Node counts of every list in every rank give the first id of each slice.
+    counts = np.zeros((len(nls),mpi.procs), dtype=np.int64)
+    for k in range(len(nls)):
+        counts[k,mpi.rank] = nls[k].numInternalNodes
+    counts = mpi.allreduce(counts, mpi.SUM)
+
+    for k in range(len(nls)):
+        gid0 = counts[:k].sum() + counts[k,:mpi.rank].sum()
+        nls[k].gid = sph.IntField('global node id',nls[k])
+        for i in range(nls[k].numInternalNodes):
+            nls[k].gid[i] = int(gid0 + i)
+            pass
+        pass
+
+    # And Bob's our uncle.
+    return
+    # End function assign_global_node_ids
+
+
 def pflatten_node_list(nl,filename,do_header=True,nl_id=0,silent=False):
     """Flatten physical field values from a node list to a rectangular ascii file.
 
@@ -567,13 +593,20 @@ def pflatten_node_list(nl,filename,do_header=True,nl_id=0,silent=False):
     list files) is 0.
 
     The format of the output table is (one line per node):
-      id eos_id x y z vx vy vz m rho p T U hmin hmax
+      id eos_id x y z vx vy vz m rho p T U hmin hmax gid
+
+    where gid is the persistent global id of the node, given by
+    assign_global_node_ids, or -1 if nl has none.
 
     The p in pflatten is for 'parallel', a reminder that all nodes will be
     processed in their local rank, without ever being communicated or collected
-    in a single process. Each mpi rank will wait its turn to access the output 
-    file, so the writing is in fact serial, but avoids bandwidth and memory waste
-    and is thus suitable for large node lists from high-res runs.
+    in a single process. Each rank formats (and, for .gz files, compresses) its
+    own block of lines in memory. A single reduction of the block sizes then gives
+    every rank the offset of its block in the file, and all ranks write at the
+    same time. A compressed file is thus a sequence of gzip members, one per rank,
+    which gzip, zcat, and numpy.loadtxt read as a single stream. This avoids
+    bandwidth and memory waste and is thus suitable for large node lists from
+    high-res runs.
 
     See also: spickle_node_list
     """
@@ -588,68 +621,22 @@ def pflatten_node_list(nl,filename,do_header=True,nl_id=0,silent=False):
     assert isinstance(nl_id, int), "int only idents"
     assert not isinstance(nl_id, bool), "int only idents"
 
-    # Determine if file should be compressed.
-    if os.path.splitext(filename)[1] == '.gz':
-        import gzip
-        open = gzip.open
-    else:
-        import __builtin__
-        open = __builtin__.open
-
-    # Write the header.
+    # Prepare the header.
+    header = None
     if do_header:
         nbGlobalNodes = mpi.allreduce(nl.numInternalNodes, mpi.SUM)
         header = header_template.format(nbGlobalNodes)
-        if mpi.rank == 0:
-            fid = open(filename,'w')
-            fid.write(header)
-            fid.close()
-            pass
         pass
      
     # Start collecting data.
     if not silent:
         sys.stdout.write('Flattening ' + nl.label() + ' ' + nl.name + '........')
     
-    # Get values of field variables stored in internal nodes.
-    xloc = nl.positions().internalValues()
-    vloc = nl.velocity().internalValues()
-    mloc = nl.mass().internalValues()
-    rloc = nl.massDensity().internalValues()
-    uloc = nl.specificThermalEnergy().internalValues()
-    Hloc = nl.Hfield().internalValues()
-    #(pressure and temperature are stored in the eos object.)
-    eos = nl.equationOfState()
-    ploc = sph.ScalarField('ploc',nl)
-    Tloc = sph.ScalarField('loc',nl)
-    rref = nl.massDensity()
-    uref = nl.specificThermalEnergy()
-    eos.setPressure(ploc,rref,uref)
-    eos.setTemperature(Tloc,rref,uref)
+    # Format internal node values of this rank.
+    block = _local_fnl_text(nl,nl_id)
 
-    # Procs take turns writing internal node values to file.
-    for proc in range(mpi.procs):
-        if proc == mpi.rank:
-            fid = open(filename,'a')
-            for nk in range(nl.numInternalNodes):
-                line  = "{:2d}  ".format(nl_id)
-                line += "{:2d}  ".format(getattr(nl,'eos_id',-1))
-                line += "{0.x:+12.5e}  {0.y:+12.5e}  {0.z:+12.5e}  ".format(xloc[nk])
-                line += "{0.x:+12.5e}  {0.y:+12.5e}  {0.z:+12.5e}  ".format(vloc[nk])
-                line += "{0:+12.5e}  ".format(mloc[nk])
-                line += "{0:+12.5e}  ".format(rloc[nk])
-                line += "{0:+12.5e}  ".format(ploc[nk])
-                line += "{0:+12.5e}  ".format(Tloc[nk])
-                line += "{0:+12.5e}  ".format(uloc[nk])
-                line += "{0:+12.5e}  ".format(Hloc[nk].Inverse().eigenValues().minElement())
-                line += "{0:+12.5e}  ".format(Hloc[nk].Inverse().eigenValues().maxElement())
-                line += "\n"
-                fid.write(line)
-                pass
-            fid.close()
-            pass
-        mpi.barrier()
-        pass
+    # All procs write their blocks at once.
+    _pwrite_ascii_blocks(filename,block,header)
      
     # And Bob's our uncle.
     if not silent:
@@ -657,17 +644,80 @@ def pflatten_node_list(nl,filename,do_header=True,nl_id=0,silent=False):
     # End function pflatten_node_list
 
 
-def pflatten_node_list_list(nls,filename,do_header=True,silent=False):
+def pflatten_node_list_list(nls,filename,do_header=True,silent=False,
+                            step=None,time=None,shards=False,background=False,
+                            precision=None):
     """Flatten a list of node lists to a rectangular ascii file.
 
     pflatten_node_list_list(nls,filename) writes meta data about the node lists
     in nls, which must be either a list or a tuple of valid node lists, to a 
-    header of the file filename, and then calls pflatten_node_list(nl,filename)
-    for each nl in nls.
+    header of the file filename, and then writes the flattened nodes of every nl
+    in nls, with nl_id set to the position of nl in nls. The rows of all node
+    lists in a rank are written together, in a single collective write (see
+    pflatten_node_list).
 
     pflatten_node_list_list(...,do_header=False) omits the header.
 
-    See also: pflatten_node_list
+    If filename has the .fnlb extension the node lists are instead written to a
+    binary columnar file, with the same columns as the ascii table stored as
+    contiguous little-endian blocks after a small fixed header. The optional step
+    and time arguments are recorded in the binary header (they are ignored for
+    ascii files). A binary file always has a header. Read it back with
+    ahelpers.load_fnl or ahelpers.load_multi_fnl.
+
+    If filename has the .h5 extension the node lists are written to an HDF5 file
+    (requires h5py). Each node list is a group holding one chunked, compressed
+    dataset per column, with its name, id, eos id and material tag as attributes;
+    step and time are attributes of the file. Ranks write their rows in turn. Read
+    it back with ahelpers.load_fnl, ahelpers.load_multi_fnl, or, for partial reads
+    by node list and row range, ahelpers.load_fnl_h5.
+
+    If filename has the .fnls extension the node lists are appended, as one more
+    binary snapshot, to a time series file holding all the snapshots of a run,
+    which is created on the first call. An index of the step, time, node count
+    and position of every snapshot is kept at the end of the file and rewritten
+    with each append, so readers can go straight to any step. The step argument
+    is required. If a restarted run appends a step at or before one already in
+    the file, the later snapshots of the earlier run are dropped from the series
+    (but not from the file). Read a time series with ahelpers.load_fnl(...,step=)
+    or ahelpers.iter_fnl_series.
+
+    pflatten_node_list_list(...,shards=True) does not write filename at all.
+    Instead every rank writes its own nodes to a complete file of the same format
+    (a shard) in the directory <root>.shards, where <root> is filename without its
+    extension, and rank 0 writes a small JSON manifest, <root>.fnlm, recording the
+    shard list, node counts, node list ids, step and time. The ranks never touch
+    the same file, so no coordination is needed beyond a single reduction of node
+    counts. Pass the manifest to ahelpers.load_fnl to read all shards as one.
+
+    pflatten_node_list_list(...,background=True) returns as soon as the field
+    values of this rank are copied to memory buffers. Formatting, compression and
+    disk writes then happen in a background thread while the caller carries on
+    (e.g., the integrator keeps stepping). Only one snapshot is written at a time:
+    the next background call first copies its own values to a second set of
+    buffers and then waits for the previous snapshot to finish. So do calls to
+    wait_for_background_output, and exit. All ranks must make the same calls, in
+    the same order. A background snapshot is complete only after that wait.
+    Shard manifests appear at that point, .fnlb files are written under a
+    temporary name and renamed then, and the index of a .fnls file is updated
+    then. The rows of an HDF5 file (unless sharded) are gathered to rank 0, whose
+    writer thread writes the whole file, so rank 0 needs memory for all of them.
+    The blocks of a compressed ascii (.gz) file can only be placed when the
+    compressed sizes of all ranks are known, so they are compressed in the
+    background but written at the wait.
+
+    pflatten_node_list_list(...,precision=p) sets the floating point type of the
+    columns of binary (.fnlb and .h5) files; ascii files are not affected. The
+    precision p is 'double' (the default), 'single' or 'half', applied to all
+    float columns, or a dict mapping column names (see fnl_column_names) to one of
+    these, with unlisted columns kept in double. The types are recorded in the
+    file and ahelpers upcasts them to double when reading. Single precision
+    halves file size and keeps 7 significant digits. Half precision keeps only 3
+    and saturates at 65504 (larger values are stored as inf, with a warning), so
+    it only suits fields like T in well chosen units; positions in meters, say,
+    will not fit.
+
+    See also: pflatten_node_list, wait_for_background_output
     """
 
     # Make sure we are not wasting our time.
@@ -679,40 +729,1038 @@ def pflatten_node_list_list(nls,filename,do_header=True,silent=False):
         assert isinstance(nl,(sph.Spheral.NodeSpace.FluidNodeList3d,
                                   sph.Spheral.SolidMaterial.SolidNodeList3d)
                          ), "argument 1 must contain node lists"
+    assert isinstance(shards, bool), "true or false"
+    assert isinstance(background, bool), "true or false"
+    if os.path.splitext(filename)[1] == fnls_extension:
+        assert step is not None, "time series snapshots need a step"
+        assert not shards, "time series can not be sharded"
+    types = _snapshot_types(precision)
+
+    # Background output is handed off to a writer thread.
+    if background:
+        _pflatten_background(nls,filename,do_header,step,time,shards,silent,
+                             types)
+        return
+    wait_for_background_output()
 
-    # Determine if file should be compressed.
-    if os.path.splitext(filename)[1] == '.gz':
-        import gzip
-        open = gzip.open
-    else:
-        import __builtin__
-        open = __builtin__.open
+    # Sharded output is written rank by rank, independently.
+    if shards:
+        _pshard_node_list_list(nls,filename,step,time,silent,types)
+        return
+
+    # Time series grow by one binary snapshot per call.
+    if os.path.splitext(filename)[1] == fnls_extension:
+        _pappend_fnls(nls,filename,step,time,silent,types)
+        return
+
+    # Binary files are written column by column.
+    if os.path.splitext(filename)[1] == fnlb_extension:
+        _pflatten_fnlb(nls,filename,step,time,silent,types)
+        return
+
+    # HDF5 files are written one rank at a time.
+    if os.path.splitext(filename)[1] == h5_extension:
+        _pflatten_h5(nls,filename,step,time,silent,types)
+        return
 
-    # Write the header.
+    # Prepare the header.
+    header = None
     if do_header:
         nbGlobalNodes = 0
         for nl in nls:
             nbGlobalNodes += mpi.allreduce(nl.numInternalNodes, mpi.SUM)
         header = header_template.format(nbGlobalNodes)
-        if mpi.rank == 0:
-            fid = open(filename,'w')
-            fid.write(header)
-            fid.close()
-            pass
         pass
 
-    # Send contents of nls to be flattened.
+    # Format contents of nls in this rank.
+    block = ''
     for k in range(len(nls)):
-        pflatten_node_list(nls[k],filename,do_header=False,nl_id=k,silent=silent)
+        if not silent:
+            sys.stdout.write('Flattening ' + nls[k].label() + ' ' +
+                             nls[k].name + '........')
+        block += _local_fnl_text(nls[k],k)
+        if not silent:
+            print "Done."
         pass
 
+    # All procs write their blocks at once.
+    _pwrite_ascii_blocks(filename,block,header)
+
     # And Bob's our uncle.
     return
     # End function pflatten_node_list_list
 
 
-global nb_fnl_columns
-nb_fnl_columns = 15
+def _pflatten_fnlb(nls,filename,step=None,time=None,silent=False,types=None):
+    """Flatten a list of node lists to a binary columnar (.fnlb) file.
+
+    Rows are grouped by node list and, within a node list, by rank. A reduction
+    of the node counts gives every rank the offset of its slice in each column
+    block, and all ranks then write their slices at the same time.
+    """
+
+    # Collect field values of this rank.
+    tables = []
+    for k in range(len(nls)):
+        if not silent:
+            sys.stdout.write('Flattening ' + nls[k].label() + ' ' +
+                             nls[k].name + '........')
+        tables.append(_local_fnl_table(nls[k],k))
+        if not silent:
+            print "Done."
+        pass
+
+    # Lay out the file, then everybody writes at once.
+    eos_ids = [getattr(nl,'eos_id',-1) for nl in nls]
+    (counts, offsets) = _pcreate_fnlb(filename,tables,eos_ids,step,time,types)
+    _pwrite_fnlb_columns(filename,tables,counts,offsets,types)
+    mpi.barrier()
+
+    # And Bob's our uncle.
+    return
+    # End function _pflatten_fnlb
+
+
+def _pcreate_fnlb(filename,tables,eos_ids,step=None,time=None,types=None,
+                  base=0):
+    """Collectively create a .fnlb file for the fnl tables of all ranks.
+
+    Rank 0 writes the header and sizes the file. Returns the node counts of every
+    list in every rank and the offsets of the column blocks. With base > 0 the
+    snapshot is instead laid out at that offset of an existing file (a .fnls
+    time series), which is cut or extended to its end.
+    """
+
+    # Rank 0 starts a new file. The counts reduction below guarantees this
+    # happens before anybody writes to it.
+    if mpi.rank == 0 and base == 0:
+        open(filename,'wb').close()
+
+    # Node counts of every list in every rank.
+    counts = np.zeros((len(tables),mpi.procs), dtype=np.int64)
+    for k in range(len(tables)):
+        counts[k,mpi.rank] = len(tables[k])
+    counts = mpi.allreduce(counts, mpi.SUM)
+    nbGlobalNodes = int(counts.sum())
+
+    # Header and column block offsets are known to all ranks.
+    if types is None:
+        types = fnlb_column_types
+    header = _fnlb_header(counts.sum(1),eos_ids,step,time,types)
+    offsets = []
+    offset = base + len(header)
+    for c in types:
+        offsets.append(offset)
+        offset += _fnlb_align(nbGlobalNodes*np.dtype('<'+c).itemsize)
+    fileSize = offset
+
+    # Slices are written inside fileSize, so they can come before or after this.
+    if mpi.rank == 0:
+        fd = os.open(filename, os.O_WRONLY|os.O_CREAT, 0o666)
+        try:
+            _pwrite(fd,base,header)
+            os.ftruncate(fd,fileSize)
+        finally:
+            os.close(fd)
+        pass
+
+    return (counts, offsets)
+    # End function _pcreate_fnlb
+
+
+def _pwrite_fnlb_columns(filename,tables,counts,offsets,types=None):
+    """Write the slices of this rank's tables into the column blocks of a .fnlb."""
+    if types is None:
+        types = fnlb_column_types
+    fd = os.open(filename, os.O_WRONLY|os.O_CREAT, 0o666)
+    try:
+        for k in range(len(tables)):
+            row0 = counts[:k].sum() + counts[k,:mpi.rank].sum()
+            for j, c in enumerate(types):
+                dt = np.dtype('<'+c)
+                _pwrite(fd,offsets[j] + row0*dt.itemsize,
+                        _typed_column(tables[k][:,j],dt,j).tostring())
+                pass
+            pass
+    finally:
+        os.close(fd)
+    # End function _pwrite_fnlb_columns
+
+
+def _pappend_fnls(nls,filename,step=None,time=None,silent=False,types=None):
+    """Append a list of node lists to a snapshot time series (.fnls) file.
+
+    The new snapshot is laid out where the index of the file starts, and written
+    exactly as a .fnlb file would be. Rank 0 then writes the extended index
+    after it.
+    """
+
+    # Collect field values of this rank.
+    tables = []
+    for k in range(len(nls)):
+        if not silent:
+            sys.stdout.write('Flattening ' + nls[k].label() + ' ' +
+                             nls[k].name + '........')
+        tables.append(_local_fnl_table(nls[k],k))
+        if not silent:
+            print "Done."
+        pass
+
+    # Find the end of the series, then everybody writes at once.
+    eos_ids = [getattr(nl,'eos_id',-1) for nl in nls]
+    (base, index) = _pbegin_fnls(filename)
+    (counts, offsets) = _pcreate_fnlb(filename,tables,eos_ids,step,time,types,
+                                      base)
+    _pwrite_fnlb_columns(filename,tables,counts,offsets,types)
+    mpi.barrier()
+
+    # Only now is the new snapshot indexed.
+    if mpi.rank == 0:
+        _write_fnls_index(filename,index,base,counts.sum(),step,time)
+    mpi.barrier()
+
+    # And Bob's our uncle.
+    return
+    # End function _pappend_fnls
+
+
+def _pbegin_fnls(filename):
+    """Collectively find the offset of the next snapshot in a .fnls file.
+
+    Rank 0 reads the index of the file, creating the file if needed, and the
+    offset where the index starts is shared with a reduction. Returns the offset
+    and, in rank 0, the index (None in other ranks).
+    """
+    base = 0
+    index = None
+    if mpi.rank == 0:
+        (base, index) = _read_fnls_index(filename)
+    base = mpi.allreduce(base, mpi.SUM)
+    return (base, index)
+
+
+def _read_fnls_index(filename):
+    """Read the index of a .fnls file, serially, starting a new file if needed.
+
+    Returns the offset of the index, where the next snapshot goes, and the index
+    records. If the file does not end with a valid footer (an append was cut
+    short) the index is rebuilt from the headers of the snapshots that are in
+    the file in full.
+    """
+    headSize = struct.calcsize(fnls_header_format)
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        with open(filename,'wb') as fid:
+            fid.write(struct.pack(fnls_header_format,fnls_magic,fnls_version))
+            pass
+        return (headSize, np.zeros(0, dtype=fnls_index_dtype))
+
+    footSize = struct.calcsize(fnls_footer_format)
+    fileSize = os.path.getsize(filename)
+    with open(filename,'rb') as fid:
+        (magic, version) = struct.unpack(fnls_header_format,
+                                         fid.read(headSize))
+        assert magic == fnls_magic, filename + " is not a .fnls time series"
+        if fileSize >= headSize + footSize:
+            fid.seek(fileSize - footSize)
+            (indexOffset, nbSnaps, magic, version) = struct.unpack(
+                fnls_footer_format, fid.read(footSize))
+            if (magic == fnls_footer_magic and indexOffset + nbSnaps*
+                fnls_index_dtype.itemsize + footSize == fileSize):
+                fid.seek(indexOffset)
+                index = np.fromfile(fid, dtype=fnls_index_dtype, count=nbSnaps)
+                return (indexOffset, index)
+            pass
+
+        # Walk the snapshots, dropping a partly written last one.
+        sys.stderr.write("WARNING: rebuilding the index of {}.\n".format(
+            filename))
+        fixedSize = struct.calcsize(fnlb_header_format)
+        records = []
+        offset = headSize
+        while offset + fixedSize <= fileSize:
+            fid.seek(offset)
+            (magic, version, nbColumns, nbLists, nbNodes, step, time,
+             dataOffset) = struct.unpack(fnlb_header_format, fid.read(fixedSize))
+            if magic != fnlb_magic:
+                break
+            end = offset + dataOffset
+            for c in fid.read(nbColumns):
+                end += _fnlb_align(nbNodes*np.dtype('<'+c).itemsize)
+            if end > fileSize:
+                break
+            records.append((step, time, nbNodes, offset))
+            offset = end
+            pass
+        pass
+    return (offset, np.array(records, dtype=fnls_index_dtype))
+
+
+def _write_fnls_index(filename,index,base,nbNodes,step=None,time=None):
+    """Write the index of a .fnls file, with a new snapshot at base, serially."""
+    record = np.zeros(1, dtype=fnls_index_dtype)
+    record['step'] = -1 if step is None else step
+    record['time'] = np.nan if time is None else time
+    record['nb_nodes'] = nbNodes
+    record['offset'] = base
+    index = np.concatenate((index,record))
+    indexOffset = os.path.getsize(filename)
+    footer = struct.pack(fnls_footer_format, indexOffset, len(index),
+                         fnls_footer_magic, fnls_version)
+    fd = os.open(filename, os.O_WRONLY)
+    try:
+        _pwrite(fd,indexOffset,index.tostring() + footer)
+    finally:
+        os.close(fd)
+    # End function _write_fnls_index
+
+
+def wait_for_background_output():
+    """Block until the snapshot being written in the background, if any, is done.
+
+    This completes the last snapshot started by pflatten_node_list_list with
+    background=True, including its collective part, so all ranks must call it
+    together. It is called automatically before every snapshot and at exit. An
+    exception raised by the writer thread is raised again here.
+    """
+
+    global _background_job
+    if _background_job is None:
+        return
+    (thread, result, finish) = _background_job
+    _background_job = None
+    thread.join()
+    if 'error' in result:
+        raise result['error'][0], result['error'][1], result['error'][2]
+    finish(result)
+    # End function wait_for_background_output
+
+
+def _pflatten_background(nls,filename,do_header=True,step=None,time=None,
+                         shards=False,silent=False,types=None):
+    """Snapshot node lists to buffers and write them from a background thread.
+
+    See pflatten_node_list_list. Field values are copied, in place, to reused
+    buffers, and all reductions done, here in the calling thread, which also
+    lays out the file so that every rank knows where its rows go. Formatting,
+    compression and writing then happen in the writer thread, which never
+    communicates. The ascii rows of a rank are placed by assuming they all have
+    the usual width; if some do not (an exponent past 99, say) the blocks are
+    written again, collectively, at the wait. Compressed ascii blocks can only be
+    placed when the compressed sizes of all ranks are known, so they are written
+    at the wait, which is collective anyway.
+    """
+
+    global _background_job, _background_slot
+
+    # Copy field values to the free set of buffers, while the previous snapshot
+    # may still be writing from the other set, then wait for it.
+    if not silent:
+        sys.stdout.write('Buffering ' + str(len(nls)) + ' node lists........')
+    _background_slot = 1 - _background_slot
+    buffers = _background_buffers[_background_slot]
+    del buffers[len(nls):]
+    tables = []
+    for k in range(len(nls)):
+        if k == len(buffers):
+            buffers.append(None)
+        buffers[k] = _local_fnl_table(nls[k],k,buffers[k])
+        tables.append(buffers[k])
+        pass
+    names = [nl.name for nl in nls]
+    eos_ids = [getattr(nl,'eos_id',-1) for nl in nls]
+    wait_for_background_output()
+
+    # Prepare the collective parts now, and decide who does what, when.
+    (root, ext) = _split_fnl_extension(filename)
+    if shards:
+        shardPath = _shard_path(root,ext,mpi.rank)
+        counts = _shard_counts(tables)
+        def work(result):
+            _write_shard(shardPath,tables,names,eos_ids,step,time,types)
+        def finish(result):
+            mpi.barrier()
+            if mpi.rank == 0:
+                _write_manifest(root,ext,names,eos_ids,counts,step,time)
+    elif ext == fnlb_extension:
+        partName = filename + '.part'
+        (counts, offsets) = _pcreate_fnlb(partName,tables,eos_ids,step,time,
+                                          types)
+        def work(result):
+            _pwrite_fnlb_columns(partName,tables,counts,offsets,types)
+        def finish(result):
+            mpi.barrier()
+            if mpi.rank == 0:
+                os.rename(partName,filename)
+    elif ext == fnls_extension:
+        (base, index) = _pbegin_fnls(filename)
+        (counts, offsets) = _pcreate_fnlb(filename,tables,eos_ids,step,time,
+                                          types,base)
+        def work(result):
+            _pwrite_fnlb_columns(filename,tables,counts,offsets,types)
+        def finish(result):
+            mpi.barrier()
+            if mpi.rank == 0:
+                _write_fnls_index(filename,index,base,counts.sum(),step,time)
+            mpi.barrier()
+    elif ext == h5_extension:
+        partName = filename + '.part'
+        tables = [_gather_rows(t) for t in tables]
+        def work(result):
+            if mpi.rank == 0:
+                _create_h5(partName,names,eos_ids,[len(t) for t in tables],
+                           step,time,types)
+                _write_h5_rows(partName,tables,[0]*len(tables))
+                os.rename(partName,filename)
+        def finish(result):
+            mpi.barrier()
+    elif ext.endswith('.gz'):
+        header = None
+        if do_header:
+            nbGlobalNodes = mpi.allreduce(sum([len(t) for t in tables]), mpi.SUM)
+            header = header_template.format(nbGlobalNodes)
+        def work(result):
+            block = ''.join([_format_fnl_rows(t) for t in tables])
+            if mpi.rank == 0 and header is not None:
+                block = header + block
+            if len(block) > 0:
+                block = _gzip_block(block)
+            result['block'] = block
+        def finish(result):
+            _pwrite_blocks(filename,result['block'],append=header is None)
+    else:
+        (base, offset, nbGlobalNodes) = _pplace_ascii_rows(filename,tables,
+                                                           do_header)
+        header = header_template.format(nbGlobalNodes) if do_header else ''
+        nbRows = sum([len(t) for t in tables])
+        size = fnl_row_width*nbRows
+        if mpi.rank == 0:
+            size += len(header)
+        else:
+            offset += len(header)
+        def work(result):
+            block = ''.join([_format_fnl_rows(t) for t in tables])
+            if mpi.rank == 0:
+                block = header + block
+            result['block'] = block
+            if len(block) == size:
+                fd = os.open(filename, os.O_WRONLY|os.O_CREAT, 0o666)
+                try:
+                    _pwrite(fd,offset,block)
+                finally:
+                    os.close(fd)
+                pass
+        def finish(result):
+            misfits = mpi.allreduce(int(len(result['block']) != size), mpi.SUM)
+            if misfits > 0:
+                if mpi.rank == 0:
+                    with open(filename,'r+b') as fid:
+                        fid.truncate(base)
+                        pass
+                _pwrite_blocks(filename,result['block'],append=True)
+            else:
+                mpi.barrier()
+
+    # Go.
+    result = {}
+    def run():
+        try:
+            work(result)
+        except:
+            result['error'] = sys.exc_info()
+    thread = threading.Thread(target=run, name='pflatten_background')
+    thread.daemon = True
+    thread.start()
+    _background_job = (thread, result, finish)
+    if not silent:
+        print "Done."
+    # End function _pflatten_background
+
+
+def _pplace_ascii_rows(filename,tables,new_file=True):
+    """Collectively lay out an ascii file for rows of the usual width.
+
+    Rank 0 starts a new file, or with new_file=False finds the end of the
+    existing one, and a single reduction of row counts gives every rank the
+    offset of its rows, assuming each takes fnl_row_width bytes. Returns the
+    base offset (the end of the existing file, or 0), the offset of the first row
+    of this rank (not counting a header), and the global row count.
+    """
+
+    # Rank 0 starts a new file or finds the end of the existing one.
+    base = 0
+    if mpi.rank == 0:
+        if new_file:
+            open(filename,'wb').close()
+        elif os.path.exists(filename):
+            base = os.path.getsize(filename)
+        pass
+
+    # The reduction also guarantees rank 0 is done before anybody writes.
+    counts = np.zeros(mpi.procs + 1, dtype=np.int64)
+    counts[0] = base
+    counts[mpi.rank + 1] = sum([len(t) for t in tables])
+    counts = mpi.allreduce(counts, mpi.SUM)
+    base = int(counts[0])
+    offset = base + fnl_row_width*int(counts[1:mpi.rank + 1].sum())
+    return (base, offset, int(counts[1:].sum()))
+    # End function _pplace_ascii_rows
+
+
+def _local_fnl_text(nl,nl_id=0):
+    """Return internal nodes of nl in this rank as lines of an fnl ascii table."""
+    return _format_fnl_rows(_local_fnl_table(nl,nl_id))
+
+
+def _format_fnl_rows(table,chunk=10000):
+    """Format an fnl table as text lines, in bulk.
+
+    Each line is identical to what "{:2d}".format and "{:+12.5e}".format produce
+    field by field, but whole chunks of rows are formatted in a single % operation
+    instead of one call per value.
+    """
+    rowfmt = 2*'%2d  ' + (nb_fnl_columns - 3)*'%+12.5e  ' + '%8d  ' + '\n'
+    blocks = []
+    for k in range(0, len(table), chunk):
+        rows = table[k:k+chunk]
+        blocks.append((rowfmt*len(rows)) % tuple(rows.ravel().tolist()))
+        pass
+    return ''.join(blocks)
+
+
+def _pwrite_ascii_blocks(filename,block,header=None):
+    """Collectively write the block of text of every rank to its own offset.
+
+    If header is not None rank 0 starts a new file with it, otherwise the blocks
+    are appended to the existing file. Blocks are gzip compressed independently if
+    filename has the .gz extension; the file is then a valid multi-member gzip.
+    """
+    if mpi.rank == 0 and header is not None:
+        block = header + block
+    if os.path.splitext(filename)[1] == '.gz' and len(block) > 0:
+        block = _gzip_block(block)
+    _pwrite_blocks(filename,block,append=header is None)
+    # End function _pwrite_ascii_blocks
+
+
+def _pwrite_blocks(filename,block,append=False):
+    """Collectively write the (ready to write) block of every rank, in rank order.
+
+    Rank 0 starts a new file, or with append=True finds the end of the existing
+    one, and every rank writes its block right after the blocks of lower ranks.
+    """
+
+    # Rank 0 starts a new file or finds the end of the existing one.
+    base = 0
+    if mpi.rank == 0:
+        if not append:
+            open(filename,'wb').close()
+        elif os.path.exists(filename):
+            base = os.path.getsize(filename)
+        pass
+
+    # A single reduction of block sizes gives every rank its offset. It also
+    # guarantees that rank 0 is done with the file before anybody writes to it.
+    sizes = np.zeros(mpi.procs + 1, dtype=np.int64)
+    sizes[0] = base
+    sizes[mpi.rank + 1] = len(block)
+    sizes = mpi.allreduce(sizes, mpi.SUM)
+
+    # Everybody writes at once.
+    fd = os.open(filename, os.O_WRONLY|os.O_CREAT, 0o666)
+    try:
+        _pwrite(fd,int(sizes[:mpi.rank + 1].sum()),block)
+    finally:
+        os.close(fd)
+    mpi.barrier()
+    # End function _pwrite_blocks
+
+
+def _pwrite(fd,offset,buf):
+    """Write all of buf at offset of open file descriptor fd."""
+    os.lseek(fd,offset,os.SEEK_SET)
+    view = memoryview(buf)
+    while len(view) > 0:
+        view = view[os.write(fd,view):]
+
+
+def _gzip_block(text):
+    """Return text compressed as a complete, standalone gzip member."""
+    import gzip
+    import cStringIO
+    sio = cStringIO.StringIO()
+    gz = gzip.GzipFile(fileobj=sio, mode='wb')
+    gz.write(text)
+    gz.close()
+    return sio.getvalue()
+
+
+def _pshard_node_list_list(nls,filename,step=None,time=None,silent=False,
+                           types=None):
+    """Write the nodes of this rank to a shard file and rank 0 writes a manifest.
+
+    See pflatten_node_list_list for the naming of shards and manifest.
+    """
+
+    # Each rank writes a complete snapshot of its own nodes.
+    if not silent:
+        sys.stdout.write('Sharding ' + str(len(nls)) + ' node lists........')
+    (root, ext) = _split_fnl_extension(filename)
+    names = [nl.name for nl in nls]
+    eos_ids = [getattr(nl,'eos_id',-1) for nl in nls]
+    tables = [_local_fnl_table(nls[k],k) for k in range(len(nls))]
+    _write_shard(_shard_path(root,ext,mpi.rank),tables,names,eos_ids,step,time,
+                 types)
+
+    # Rank 0 writes the manifest, after the reduction shows all shards are done.
+    counts = _shard_counts(tables)
+    if mpi.rank == 0:
+        _write_manifest(root,ext,names,eos_ids,counts,step,time)
+
+    # And Bob's our uncle.
+    if not silent:
+        print "Done."
+    return
+    # End function _pshard_node_list_list
+
+
+def _shard_path(root,ext,rank):
+    """Return the path of the shard of rank, creating the shard directory."""
+    shardDir = root + '.shards'
+    if not os.path.isdir(shardDir):
+        try:
+            os.makedirs(shardDir)
+        except OSError: # another rank beat us to it
+            pass
+        pass
+    return os.path.join(shardDir, 'rank{:04d}{}'.format(rank, ext))
+
+
+def _shard_counts(tables):
+    """Reduce the node counts of every list in every rank (rows are ranks)."""
+    counts = np.zeros((mpi.procs,len(tables)), dtype=np.int64)
+    counts[mpi.rank] = [len(t) for t in tables]
+    return mpi.allreduce(counts, mpi.SUM)
+
+
+def _write_shard(shardPath,tables,names,eos_ids,step=None,time=None,types=None):
+    """Write fnl tables of this rank to a complete snapshot file, serially."""
+    ext = _split_fnl_extension(shardPath)[1]
+    if ext == fnlb_extension:
+        _write_fnlb(shardPath,tables,eos_ids,step,time,types)
+    elif ext == h5_extension:
+        _create_h5(shardPath,names,eos_ids,[len(t) for t in tables],step,time,
+                   types)
+        _write_h5_rows(shardPath,tables,[0]*len(tables))
+    else:
+        text = header_template.format(sum([len(t) for t in tables]))
+        text += ''.join([_format_fnl_rows(t) for t in tables])
+        if ext.endswith('.gz'):
+            text = _gzip_block(text)
+        with open(shardPath,'wb') as fid:
+            fid.write(text)
+            pass
+        pass
+    # End function _write_shard
+
+
+def _write_manifest(root,ext,names,eos_ids,counts,step=None,time=None):
+    """Write the JSON manifest of a sharded snapshot to <root>.fnlm."""
+    shardDir = os.path.basename(root + '.shards')
+    manifest = dict(format='fnlm',
+                    version=1,
+                    step=-1 if step is None else int(step),
+                    time=float('nan') if time is None else float(time),
+                    nb_nodes=int(counts.sum()),
+                    nb_lists=len(names),
+                    nl_ids=range(len(names)),
+                    nl_names=list(names),
+                    eos_ids=[int(e) for e in eos_ids],
+                    shards=[dict(file=os.path.join(shardDir,
+                                     'rank{:04d}{}'.format(r, ext)),
+                                 counts=[int(c) for c in counts[r]])
+                            for r in range(len(counts))],
+                    )
+    with open(root + '.fnlm','w') as fid:
+        json.dump(manifest, fid, indent=1, sort_keys=True,
+                  separators=(',', ': '))
+        pass
+    # End function _write_manifest
+
+
+def _split_fnl_extension(filename):
+    """Split filename to root and one of the known snapshot extensions."""
+    for ext in (fnlb_extension, fnls_extension, h5_extension, '.fnl.gz', '.fnl'):
+        if filename.endswith(ext):
+            return (filename[:-len(ext)], ext)
+    return os.path.splitext(filename)
+
+
+def _write_fnlb(filename,tables,eos_ids,step=None,time=None,types=None):
+    """Write fnl tables of one or more node lists to a .fnlb file, serially."""
+    if types is None:
+        types = fnlb_column_types
+    counts = [len(t) for t in tables]
+    table = np.vstack([t.reshape((-1,nb_fnl_columns)) for t in tables])
+    with open(filename,'wb') as fid:
+        fid.write(_fnlb_header(counts,eos_ids,step,time,types))
+        for j, c in enumerate(types):
+            col = _typed_column(table[:,j],np.dtype('<'+c),j).tostring()
+            fid.write(col + '\0'*(_fnlb_align(len(col)) - len(col)))
+            pass
+        pass
+    # End function _write_fnlb
+
+
+def _pflatten_h5(nls,filename,step=None,time=None,silent=False,types=None):
+    """Flatten a list of node lists to an HDF5 file, one group per node list.
+
+    Rank 0 creates the file with all datasets at their final sizes, and then the
+    ranks take turns, in rank order, writing their rows into them. Rows are thus
+    grouped by rank within each node list, as in .fnlb files. (h5py is rarely
+    built against parallel HDF5, so we do not rely on collective writes.)
+    """
+
+    # Node counts of every list in every rank.
+    nbLists = len(nls)
+    counts = np.zeros((nbLists,mpi.procs), dtype=np.int64)
+    for k in range(nbLists):
+        counts[k,mpi.rank] = nls[k].numInternalNodes
+    counts = mpi.allreduce(counts, mpi.SUM)
+
+    # Collect local values before taking turns, so ranks only wait for the disk.
+    tables = []
+    for k in range(nbLists):
+        if not silent:
+            sys.stdout.write('Flattening ' + nls[k].label() + ' ' +
+                             nls[k].name + '........')
+        tables.append(_local_fnl_table(nls[k],k))
+        if not silent:
+            print "Done."
+        pass
+
+    # Rank 0 lays out the file, then everybody writes in turn.
+    if mpi.rank == 0:
+        _create_h5(filename,[nl.name for nl in nls],
+                   [getattr(nl,'eos_id',-1) for nl in nls],counts.sum(1),
+                   step,time,types)
+    mpi.barrier()
+    for rank in range(mpi.procs):
+        if rank == mpi.rank and counts[:,rank].sum() > 0:
+            _write_h5_rows(filename,tables,counts[:,:rank].sum(1))
+        mpi.barrier()
+        pass
+
+    # And Bob's our uncle.
+    return
+    # End function _pflatten_h5
+
+
+def _create_h5(filename,names,eos_ids,counts,step=None,time=None,types=None):
+    """Create an HDF5 snapshot with empty datasets for counts[k] nodes of list k.
+
+    The node list names and eos ids are given in names and eos_ids, and the
+    column types in types (default fnlb_column_types).
+    """
+    import h5py
+    if types is None:
+        types = fnlb_column_types
+    with h5py.File(filename,'w') as f:
+        f.attrs['format'] = 'fnl'
+        f.attrs['version'] = h5_version
+        f.attrs['step'] = -1 if step is None else int(step)
+        f.attrs['time'] = np.nan if time is None else float(time)
+        f.attrs['nb_lists'] = len(names)
+        f.attrs['nb_nodes'] = int(np.sum(counts))
+        for k in range(len(names)):
+            eos_id = eos_ids[k]
+            g = f.create_group(h5_group_format.format(k))
+            g.attrs['name'] = names[k]
+            g.attrs['nl_id'] = k
+            g.attrs['eos_id'] = eos_id
+            g.attrs['material'] = _material_tag(eos_id)
+            g.attrs['nb_nodes'] = int(counts[k])
+            for j, name in enumerate(h5_column_names):
+                _create_h5_dataset(g,name,(int(counts[k]),),'<'+types[j])
+                pass
+            pass
+        pass
+    # End function _create_h5
+
+
+def _create_h5_dataset(group,name,shape,dtype,data=None):
+    """Create a dataset, chunked and compressed unless it is empty."""
+    if shape[0] == 0:
+        return group.create_dataset(name,shape,dtype=dtype,data=data)
+    chunks = (min(shape[0],h5_chunk_rows),) + tuple(shape[1:])
+    return group.create_dataset(name,shape,dtype=dtype,data=data,chunks=chunks,
+                                compression=h5_compression,shuffle=True)
+
+
+def _write_h5_rows(filename,tables,row0s):
+    """Write fnl tables into the node list datasets of an HDF5 snapshot.
+
+    The rows of tables[k] are written to group k starting at row row0s[k].
+    """
+    import h5py
+    with h5py.File(filename,'r+') as f:
+        for k, table in enumerate(tables):
+            if len(table) == 0:
+                continue
+            g = f[h5_group_format.format(k)]
+            a = int(row0s[k])
+            for j, name in enumerate(h5_column_names):
+                g[name][a:a + len(table)] = _typed_column(table[:,j],
+                                                          g[name].dtype,j)
+                pass
+            pass
+        pass
+    # End function _write_h5_rows
+
+
+def _write_h5_dict(filename,fieldDict,eos_id=-1):
+    """Save a dict made by spickle_node_list to an HDF5 file."""
+    import h5py
+    with h5py.File(filename,'w') as f:
+        f.attrs['format'] = 'spickle'
+        f.attrs['version'] = h5_version
+        f.attrs['name'] = fieldDict['name']
+        f.attrs['eos_id'] = eos_id
+        f.attrs['material'] = _material_tag(eos_id)
+        for key, value in fieldDict.items():
+            if key == 'name':
+                continue
+            data = np.array(value, dtype=np.float64)
+            _create_h5_dataset(f,key,data.shape,data.dtype,data)
+            pass
+        pass
+    # End function _write_h5_dict
+
+
+def _write_npz_dict(filename,fieldDict,eos_id=-1):
+    """Save a dict made by spickle_node_list to an .npz file."""
+    arrays = dict((key, value) for key, value in fieldDict.items()
+                  if key != 'name')
+    with open(filename,'wb') as fid:
+        np.savez(fid, name=np.array(fieldDict['name']), eos_id=np.array(eos_id),
+                 material=np.array(_material_tag(eos_id)), **arrays)
+        pass
+    # End function _write_npz_dict
+
+
+def _gather_rows(local):
+    """Gather the rows of a local float array from all ranks to rank 0.
+
+    Returns the rows of all ranks, in rank order, in rank 0 and None elsewhere.
+    With mpi4py the data travel as typed buffers in one Gatherv, otherwise each
+    rank's array is sent whole with mpi.gather.
+    """
+
+    local = np.ascontiguousarray(local, dtype=np.float64)
+    if mpi.procs == 1:
+        return local
+    try:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        assert comm.Get_size() == mpi.procs and comm.Get_rank() == mpi.rank
+    except (ImportError, AssertionError):
+        comm = None
+
+    if comm is not None:
+        counts = comm.gather(local.size, root=0)
+        if mpi.rank == 0:
+            counts = np.array(counts, dtype=np.int64)
+            displs = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            table = np.empty(counts.sum(), dtype=np.float64)
+            comm.Gatherv(local.ravel(), [table, counts, displs, MPI.DOUBLE], root=0)
+            return table.reshape((-1,) + local.shape[1:])
+        comm.Gatherv(local.ravel(), None, root=0)
+        return None
+
+    parts = mpi.gather(local)
+    if mpi.rank == 0:
+        return np.concatenate(parts)
+    return None
+    # End function _gather_rows
+
+
+def _material_tag(eos_id):
+    """Return the material_dictionary tag with the given eos id, or ''."""
+    for tag, mat in material_dictionary.items():
+        if mat['eos_id'] == eos_id:
+            return tag
+    return ''
+
+
+def _local_field_arrays(nl,out=None):
+    """Return field values of internal nodes in this rank as a dict of arrays.
+
+    The keys are those of spickle_field_names. Vector fields x, v and h (the
+    smoothing ellipsoid half-axes, in ascending order) have one row per node. If
+    out is a dict of arrays (or array views) of the right shapes, for some of
+    the keys, those values are written into them instead of new arrays.
+    """
+
+    #(pressure and temperature are stored in the eos object.)
+    eos = nl.equationOfState()
+    ploc = sph.ScalarField('ploc',nl)
+    Tloc = sph.ScalarField('loc',nl)
+    rref = nl.massDensity()
+    uref = nl.specificThermalEnergy()
+    eos.setPressure(ploc,rref,uref)
+    eos.setTemperature(Tloc,rref,uref)
+
+    # Pull everything into arrays once.
+    n = nl.numInternalNodes
+    fields = dict(out or {})
+    for key in spickle_field_names:
+        if key not in fields:
+            fields[key] = np.zeros((n,3) if key in ('x','v','h') else n)
+    if n == 0:
+        return fields
+    fields['x'][:] = _field_values(nl.positions(),n,('x','y','z'))
+    fields['v'][:] = _field_values(nl.velocity(),n,('x','y','z'))
+    fields['m'][:] = _field_values(nl.mass(),n)
+    fields['rho'][:] = _field_values(nl.massDensity(),n)
+    fields['p'][:] = _field_values(ploc,n)
+    fields['T'][:] = _field_values(Tloc,n)
+    fields['U'][:] = _field_values(nl.specificThermalEnergy(),n)
+
+    # The smoothing ellipsoid half-axes are the eigenvalues of H^-1, that is the
+    # reciprocals of the eigenvalues of (symmetric) H, found in one batched call.
+    H = _field_values(nl.Hfield(),n,('xx','xy','xz',
+                                     'xy','yy','yz',
+                                     'xz','yz','zz')).reshape((n,3,3))
+    fields['h'][:] = 1.0/np.linalg.eigvalsh(H)[:,::-1]
+
+    return fields
+    # End function _local_field_arrays
+
+
+def _field_values(field,n,components=None):
+    """Return the values of the n internal nodes of a field as an array.
+
+    The values of a scalar field are read in a single np.fromiter pass. Vectors
+    and tensors index like sequences of their components, so numpy converts the
+    values of their fields to an (n,k) array in one call; components names the k
+    components in sequence order, as attributes, and they are read one node at a
+    time only if the values do not convert (as with older Spheral wrappers).
+    """
+    values = field.internalValues()
+    if components is None:
+        return np.fromiter(values, dtype=np.float64, count=n)
+    try:
+        table = np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        table = None
+    if table is None or table.shape != (n,len(components)):
+        table = np.array([[getattr(v,c) for c in components] for v in values],
+                         dtype=np.float64)
+    return table.reshape((n,len(components)))
+
+
+def _local_fnl_table(nl,nl_id=0,out=None):
+    """Return field values of internal nodes in this rank as an fnl table.
+
+    The returned array has one row per internal node and the same nb_fnl_columns
+    columns, in the same order, as the rows written by pflatten_node_list. If out
+    is an array of the right shape the table is written into it.
+    """
+
+    n = nl.numInternalNodes
+    if out is not None and out.shape == (n,nb_fnl_columns):
+        table = out
+    else:
+        table = np.zeros((n,nb_fnl_columns))
+    fields = _local_field_arrays(nl,dict(x=table[:,2:5], v=table[:,5:8],
+                                         m=table[:,8], rho=table[:,9],
+                                         p=table[:,10], T=table[:,11],
+                                         U=table[:,12]))
+    table[:, 0] = nl_id
+    table[:, 1] = getattr(nl,'eos_id',-1)
+    table[:,13] = fields['h'][:,0]
+    table[:,14] = fields['h'][:,2]
+    table[:,15] = -1
+
+    # Persistent global ids, if the node list was given them.
+    if hasattr(nl,'gid'):
+        table[:,15] = _field_values(nl.gid,n)
+
+    return table
+    # End function _local_fnl_table
+
+
+def _snapshot_types(precision=None):
+    """Return the column type characters for a snapshot precision option.
+
+    See pflatten_node_list_list for the accepted values of precision.
+    """
+    if precision is None:
+        return fnlb_column_types
+    floats = [name for name, c in zip(fnl_column_names,fnlb_column_types)
+              if c == 'd']
+    if isinstance(precision,str):
+        precision = dict.fromkeys(floats,precision)
+    assert isinstance(precision,dict), "precision must be a string or a dict"
+    types = list(fnlb_column_types)
+    for name, p in precision.items():
+        assert name in floats, "no float column named " + name
+        assert p in precision_types, "precision is one of " + \
+            str(precision_types.keys())
+        types[fnl_column_names.index(name)] = precision_types[p]
+        pass
+    return ''.join(types)
+
+
+def _typed_column(col,dtype,j=None):
+    """Convert a column to dtype, warning if values overflow a float type."""
+    out = col.astype(dtype)
+    if dtype.kind == 'f' and dtype.itemsize < 8:
+        bad = np.isinf(out) & np.isfinite(col)
+        if bad.any():
+            name = fnl_column_names[j] if j is not None else '?'
+            sys.stderr.write("WARNING: {} values of column {} overflow {}; "
+                             "stored as inf.\n".format(bad.sum(), name,
+                                                       dtype.name))
+        pass
+    return out
+
+
+def _fnlb_header(counts,eos_ids,step=None,time=None,types=None):
+    """Pack a .fnlb header, zero-padded to the start of the column blocks.
+
+    See fnlb_header_format for the layout; it must match ahelpers.FNLBMeta.
+    """
+    if types is None:
+        types = fnlb_column_types
+    if step is None:
+        step = -1
+    if time is None:
+        time = np.nan
+    nbLists = len(counts)
+    size = struct.calcsize(fnlb_header_format) + len(types) + 12*nbLists
+    head = struct.pack(fnlb_header_format, fnlb_magic, fnlb_version,
+                       len(types), nbLists, int(np.sum(counts)), int(step),
+                       float(time), _fnlb_align(size))
+    head += types
+    head += np.asarray(counts, dtype='<i8').tostring()
+    head += np.asarray(eos_ids, dtype='<i4').tostring()
+    return head + '\0'*(_fnlb_align(size) - size)
+
+
+def _fnlb_align(nbytes):
+    return ((nbytes + fnlb_alignment - 1)//fnlb_alignment)*fnlb_alignment
+
+
+global nb_fnl_columns, fnl_column_names, precision_types
+nb_fnl_columns = 16
+fnl_column_names = ('id', 'eos', 'x', 'y', 'z', 'vx', 'vy', 'vz', 'm', 'rho', 'P',
+                    'T', 'U', 'hmin', 'hmax', 'gid')
+# Column type characters of the precision options of binary snapshots.
+precision_types = {'double':'d', 'single':'f', 'half':'e'}
+
+global fnl_row_width
+# Width in bytes of an ascii row, unless a value does not fit its usual format.
+fnl_row_width = 2*4 + (nb_fnl_columns - 3)*14 + 10 + 1
 
 global header_template
 header_template = """\
@@ -721,10 +1769,12 @@ header_template = """\
 # field variables as well as some diagnostic data and node meta data. This
 # file should contain {} data lines, one per SPH node used in the simulation.
 # Line order is not significant and is not guaranteed to match the node ordering
-# during the run, which itself is not significant. The columns contain field
-# values in whatever units where used in the simulation. Usually MKS.
+# during the run, which itself is not significant; match nodes by gid instead.
+# The columns contain field values in whatever units where used in the
+# simulation. Usually MKS.
 # Columns are:
 #  | id | eos_id | x | y | z | vx | vy | vz | m | rho | p | T | U | hmin | hmax |
+#  | gid |
 #
 # Column legend:
 #    
@@ -738,12 +1788,79 @@ header_template = """\
 #         T - temperature
 #         U - specific internal energy
 # hmin,hmax - smallest and largest half-axes of the smoothing ellipsoid 
+#       gid - persistent global id of the node, or -1 if it has none
 #
 # Tip: load table into python with np.loadtxt()
 #
 ################################################################################
 """
 
+global fnlb_extension, fnlb_magic, fnlb_version, fnlb_header_format
+global fnlb_column_types, fnlb_alignment
+# Layout of binary flattened node list (.fnlb) files. A fixed header packed with
+# fnlb_header_format (magic, version, nb_columns, nb_lists, nb_nodes, step, time,
+# data_offset) is followed by one type character per column, the int64 node
+# count and int32 eos id of each node list, and zero padding up to data_offset.
+# Then come the column blocks, in the same order as the ascii columns, each
+# holding nb_nodes little-endian values and padded to fnlb_alignment bytes.
+# Keep in sync with <pcs>/Analysis/ahelpers.FNLBMeta.
+fnlb_extension = '.fnlb'
+fnlb_magic = 'FNLB'
+fnlb_version = 1
+fnlb_header_format = '<4siiiqqdq'
+fnlb_column_types = 'ii' + (nb_fnl_columns - 3)*'d' + 'i'
+fnlb_alignment = 8
+
+global fnls_extension, fnls_magic, fnls_version, fnls_header_format
+global fnls_index_dtype, fnls_footer_format, fnls_footer_magic
+# Layout of snapshot time series (.fnls) files. A short header packed with
+# fnls_header_format (magic, version) is followed by complete .fnlb snapshots, in
+# the order they were written, each at a multiple of fnlb_alignment bytes. After
+# the last one comes the index, a fnls_index_dtype record (step, time, nb_nodes,
+# offset of the snapshot) per snapshot, and then a footer packed with
+# fnls_footer_format (index offset, nb of snapshots, fnls_footer_magic, version)
+# that ends the file. An append overwrites the index and writes a longer one.
+# Keep in sync with <pcs>/Analysis/ahelpers.FNLSMeta.
+fnls_extension = '.fnls'
+fnls_magic = 'FNLS'
+fnls_version = 1
+fnls_header_format = '<4si'
+fnls_index_dtype = np.dtype([('step','<i8'), ('time','<f8'),
+                             ('nb_nodes','<i8'), ('offset','<i8')])
+fnls_footer_format = '<qq4si'
+fnls_footer_magic = 'FNLX'
+
+global spickle_field_names
+global npz_extension
+# Fields in the dict made by spickle_node_list, in the order they are packed for
+# the gather, and the extension of the .npz files it can save the dict to.
+# Keep in sync with <pcs>/Analysis/ahelpers.load_spickle.
+spickle_field_names = ('x', 'v', 'm', 'rho', 'p', 'T', 'U', 'h')
+npz_extension = '.npz'
+
+global h5_extension, h5_version, h5_group_format, h5_column_names
+global h5_chunk_rows, h5_compression
+# Layout of HDF5 snapshots. The file attributes are format ('fnl'), version,
+# step, time, nb_lists and nb_nodes. Node list k is the group h5_group_format
+# .format(k), with attributes name, nl_id, eos_id, material and nb_nodes, holding
+# one dataset per ascii column, named by h5_column_names and typed as in .fnlb
+# (so by default; see the precision option of pflatten_node_list_list).
+# Keep in sync with <pcs>/Analysis/ahelpers.FNLH5Meta.
+h5_extension = '.h5'
+h5_version = 1
+h5_group_format = 'nl{:d}'
+h5_column_names = fnl_column_names
+h5_chunk_rows = 65536
+h5_compression = 'gzip'
+
+global _background_job, _background_slot, _background_buffers
+# State of background snapshot output (see pflatten_node_list_list): the job in
+# flight as (thread, result, finish), and two sets of reusable table buffers.
+_background_job = None
+_background_slot = 0
+_background_buffers = ([], [])
+atexit.register(wait_for_background_output)
+
 global material_dictionary
 # A dictionary of unique short tags for commonly used material EOSs.
 # We use this in spite of the added complexity to allow users of pcs to specify 